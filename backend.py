@@ -7,6 +7,8 @@ import subprocess
 import datetime
 import re
 import tempfile
+import time
+import concurrent.futures
 
 import repository
 import generalui
@@ -51,11 +53,14 @@ class Task:
     'returns' is a list of the labels of the return values, or a function
            that, when given the 'args' labels list, returns the list of the
            labels of the return values.
+    'resources' is a list of the shared resources (RESOURCE_*) the step
+           touches besides its labels, or None if the step must not run
+           alongside any other step.
     """
 
     def __init__(self, fn, args, returns, args_sensitive=False,
                  progress_scale=1, pass_progress_callback=False,
-                 progress_text=None):
+                 progress_text=None, resources=None):
         self.fn = fn
         self.args = args
         self.returns = returns
@@ -63,6 +68,34 @@ class Task:
         self.progress_scale = progress_scale
         self.pass_progress_callback = pass_progress_callback
         self.progress_text = progress_text
+        self.resources = resources
+
+    def reads(self):
+        """ Labels read by the task, or None if they cannot be determined. """
+        return getattr(self.args, 'labels', None)
+
+    def writes(self):
+        """ Labels written by the task, or None if they cannot be determined. """
+        if callable(self.returns):
+            return None
+        return self.returns
+
+    def isBarrier(self):
+        """ A barrier task runs on its own, after all tasks preceding it have
+        completed and before any task following it starts. """
+        return (self.resources is None or self.pass_progress_callback or
+                self.reads() is None or self.writes() is None)
+
+    def dependsOn(self, other):
+        """ Returns True if this task must run after 'other', which precedes
+        it in the sequence. """
+        if self.isBarrier() or other.isBarrier():
+            return True
+        reads, writes = set(self.reads()), set(self.writes())
+        other_reads, other_writes = set(other.reads()), set(other.writes())
+        return bool(reads & other_writes or writes & other_reads or
+                    writes & other_writes or
+                    set(self.resources) & set(other.resources))
 
     def execute(self, answers, progress_callback=lambda x: ()):
         args = self.args(answers)
@@ -76,7 +109,14 @@ class Task:
         if self.pass_progress_callback:
             args.insert(0, progress_callback)
 
-        rv = self.fn(*args)
+        before = resourceUsage()
+        try:
+            rv = self.fn(*args)
+        finally:
+            self.profile = profileSince(before)
+            self.profile['task'] = getattr(self.fn, '__qualname__', str(self.fn))
+            logger.log("TASK: %s took %.2fs" % (self.profile['task'], self.profile['wall-time']))
+            xelogging.recordTaskProfile(self.profile)
         if type(rv) is not tuple:
             rv = (rv,)
         myrv = {}
@@ -90,6 +130,29 @@ class Task:
             myrv[ret[r]] = rv[r]
         return myrv
 
+def resourceUsage():
+    """ Snapshot of the counters reported in the install profile, for the
+    calling thread.  CPU time and bytes written include the subprocesses it
+    has reaped with util.waitSubprocess (all those run by runCmd2), so tasks
+    running concurrently are not charged for each other's. """
+    child_cpu_time, child_bytes_written = util.subprocessUsage()
+    return {
+        'wall-time': time.time(),
+        'cpu-time': time.thread_time() + child_cpu_time,
+        'subprocesses': util.subprocessCount(),
+        'bytes-written': util.threadBytesWritten() + child_bytes_written,
+        }
+
+def profileSince(before):
+    """ Returns the difference between the current resourceUsage() and
+    before. """
+    now = resourceUsage()
+    return dict((k, now[k] - before[k]) for k in now)
+
+# Shared resources a Task may declare in addition to its labels.  Tasks
+# declaring the same resource never run concurrently.
+RESOURCE_ROOT = 'root' # chroots into, or bind mounts under, mounts['root']
+
 ###
 # INSTALL SEQUENCES:
 # convenience functions
@@ -97,8 +160,16 @@ class Task:
 #    the labels when the function is called (late-binding)
 # As: As above but evaluated immediately (early-binding)
 # Use A when you require state values as well as the initial input values
-A = lambda ans, *params: ( lambda a: [a.get(param) for param in params] )
-As = lambda ans, *params: ( lambda _: [ans.get(param) for param in params] )
+# Both record the labels read so that independent tasks can be identified.
+def A(ans, *params):
+    fn = lambda a: [a.get(param) for param in params]
+    fn.labels = params
+    return fn
+
+def As(ans, *params):
+    fn = lambda _: [ans.get(param) for param in params]
+    fn.labels = ()
+    return fn
 
 def getPrepSequence(ans, interactive):
     seq = [
@@ -172,19 +243,19 @@ def getRepoSequence(ans, repos):
 
 def getFinalisationSequence(ans):
     seq = [
-        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), []),
-        Task(writeMachineID, A(ans, 'mounts'), []),
-        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), []),
+        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), [], resources=[]),
+        Task(writeMachineID, A(ans, 'mounts'), [], resources=[RESOURCE_ROOT]),
+        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), [], resources=[]),
         Task(configureNetworking, A(ans, 'mounts', 'net-admin-interface', 'net-admin-bridge', 'net-admin-configuration', 'manual-hostname', 'manual-nameservers', 'network-hardware', 'preserve-settings', 'network-backend'), []),
         Task(prepareSwapfile, A(ans, 'mounts', 'primary-disk', 'swap-partnum', 'disk-label-suffix'), []),
         Task(writeFstab, A(ans, 'mounts', 'target-boot-mode', 'primary-disk', 'logs-partnum', 'swap-partnum', 'disk-label-suffix'), []),
-        Task(enableAgent, A(ans, 'mounts', 'network-backend', 'services'), []),
-        Task(configureCC, A(ans, 'mounts'), []),
+        Task(enableAgent, A(ans, 'mounts', 'network-backend', 'services'), [], resources=[RESOURCE_ROOT]),
+        Task(configureCC, A(ans, 'mounts'), [], resources=[RESOURCE_ROOT]),
         Task(configureLogrotate, A(ans, 'mounts', 'primary-disk', 'logs-partnum'), []),
         Task(writeInventory, A(ans, 'installation-uuid', 'control-domain-uuid', 'mounts', 'primary-disk',
                                'backup-partnum', 'storage-partnum', 'guest-disks', 'net-admin-bridge',
-                               'branding', 'net-admin-configuration', 'host-config', 'install-type'), []),
-        Task(writeXencommons, A(ans, 'control-domain-uuid', 'mounts'), []),
+                               'branding', 'net-admin-configuration', 'host-config', 'install-type'), [], resources=[]),
+        Task(writeXencommons, A(ans, 'control-domain-uuid', 'mounts'), [], resources=[]),
         Task(configureISCSI, A(ans, 'mounts', 'primary-disk'), []),
         Task(mkinitrd, A(ans, 'mounts', 'primary-disk', 'primary-partnum',
                               'fcoe-interfaces'), []),
@@ -193,11 +264,11 @@ def getFinalisationSequence(ans):
                                   'boot-partnum', 'primary-partnum', 'target-boot-mode', 'branding',
                                   'disk-label-suffix', 'bootloader-location', 'write-boot-entry', 'install-type',
                                   'serial-console', 'boot-serial', 'host-config', 'fcoe-interfaces'), []),
-        Task(touchSshAuthorizedKeys, A(ans, 'mounts'), []),
-        Task(setRootPassword, A(ans, 'mounts', 'root-password'), [], args_sensitive=True),
-        Task(setTimeZone, A(ans, 'mounts', 'timezone'), []),
-        Task(writei18n, A(ans, 'mounts'), []),
-        Task(configureMCELog, A(ans, 'mounts'), []),
+        Task(touchSshAuthorizedKeys, A(ans, 'mounts'), [], resources=[]),
+        Task(setRootPassword, A(ans, 'mounts', 'root-password'), [], args_sensitive=True, resources=[RESOURCE_ROOT]),
+        Task(setTimeZone, A(ans, 'mounts', 'timezone'), [], resources=[]),
+        Task(writei18n, A(ans, 'mounts'), [], resources=[]),
+        Task(configureMCELog, A(ans, 'mounts'), [], resources=[RESOURCE_ROOT]),
         ]
 
     # on fresh installs, prepare the storage repository as required:
@@ -248,6 +319,7 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
             seq_name, progress_total
             )
     logger.log("DISPATCH: NEW PHASE: %s" % seq_name)
+    xelogging.startProfilePhase(seq_name)
 
     def doCleanup(actions):
         for tag, f, a in actions:
@@ -260,26 +332,38 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
         if ui:
             ui.progress.displayProgressDialog(current + x, pd)
 
+    def displayTask(item):
+        if pd:
+            if item.progress_text:
+                text = item.progress_text
+            else:
+                text = seq_name
+
+            ui.progress.displayProgressDialog(current, pd, updated_text=text)
+
+    def applyState(updated_state):
+        if len(updated_state) > 0:
+            logger.log(
+                "DISPATCH: Updated state: %s" %
+                "; ".join(["%s -> %s" % (k, v) for k, v in updated_state.items()])
+                )
+            for state_item in updated_state:
+                answers[state_item] = updated_state[state_item]
+
     try:
         current = 0
-        for item in sequence:
-            if pd:
-                if item.progress_text:
-                    text = item.progress_text
-                else:
-                    text = seq_name
-
-                ui.progress.displayProgressDialog(current, pd, updated_text=text)
-            updated_state = item.execute(answers, progressCallback)
-            if len(updated_state) > 0:
-                logger.log(
-                    "DISPATCH: Updated state: %s" %
-                    "; ".join(["%s -> %s" % (k, v) for k, v in updated_state.items()])
-                    )
-                for state_item in updated_state:
-                    answers[state_item] = updated_state[state_item]
-
-            current = current + item.progress_scale
+        if constants.PARALLEL_TASKS:
+            for item, updated_state in executeConcurrently(sequence, answers, progressCallback, displayTask):
+                applyState(updated_state)
+                current = current + item.progress_scale
+                if pd:
+                    ui.progress.displayProgressDialog(current, pd)
+        else:
+            for item in sequence:
+                displayTask(item)
+                applyState(item.execute(answers, progressCallback))
+
+                current = current + item.progress_scale
     except:
         doCleanup(answers['cleanup'])
         raise
@@ -291,6 +375,52 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
             doCleanup(answers['cleanup'])
             del answers['cleanup']
 
+def executeConcurrently(sequence, answers, progress_callback, task_started=lambda x: ()):
+    """ Generator which runs the tasks in sequence, starting each one as soon
+    as the tasks it depends on have completed.  Yields (task, updated_state)
+    as each task completes; the caller must apply updated_state to answers
+    before resuming the generator.  Barrier tasks run in the calling thread
+    so that they may drive the UI. """
+
+    deps = [set(j for j in range(i) if sequence[i].dependsOn(sequence[j]))
+            for i in range(len(sequence))]
+    pending = list(range(len(sequence)))
+    done = set()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(constants.PARALLEL_TASK_WORKERS) as pool:
+        try:
+            while pending or running:
+                ready = [i for i in pending if deps[i] <= done]
+                for i in ready:
+                    if sequence[i].isBarrier():
+                        # deps[i] covers every preceding task, so nothing
+                        # else can be running at this point.
+                        assert not running
+                        pending.remove(i)
+                        task_started(sequence[i])
+                        updated_state = sequence[i].execute(answers, progress_callback)
+                        done.add(i)
+                        yield sequence[i], updated_state
+                        break
+                    pending.remove(i)
+                    # Hand each task its own view of the answers so that state
+                    # applied by the caller cannot change under its feet.
+                    running[pool.submit(sequence[i].execute, dict(answers))] = i
+                if not running:
+                    continue
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    i = running.pop(future)
+                    updated_state = future.result()
+                    done.add(i)
+                    yield sequence[i], updated_state
+        finally:
+            for future in running:
+                future.cancel()
+
 def performInstallation(answers, ui_package, interactive):
     logger.log("INPUT ANSWERS DICTIONARY:")
     prettyLogAnswers(answers)
@@ -588,6 +718,7 @@ def removeBlockingVGs(disks):
         util.runCmd2(['vgreduce', '--removemissing', vg])
         util.runCmd2(['lvremove', vg])
         util.runCmd2(['vgremove', vg])
+    LVMTool.invalidateSnapshot()
 
 ###
 # Functions to write partition tables to disk
@@ -1462,6 +1593,7 @@ def setRootPassword(mounts, root_pwd):
     (pwdtype, root_password) = root_pwd
     if pwdtype == 'pwdhash':
         cmd = ["/usr/sbin/chroot", mounts["root"], "chpasswd", "-e"]
+        util.countSubprocess()
         pipe = subprocess.Popen(cmd, stdin=subprocess.PIPE,
                                      stdout=subprocess.PIPE,
                                      close_fds=True,
@@ -1470,6 +1602,7 @@ def setRootPassword(mounts, root_pwd):
         assert pipe.wait() == 0
     else:
         cmd = ["/usr/sbin/chroot", mounts['root'], "passwd", "--stdin", "root"]
+        util.countSubprocess()
         pipe = subprocess.Popen(cmd, stdin=subprocess.PIPE,
                                      stdout=subprocess.PIPE,
                                      stderr=subprocess.PIPE,
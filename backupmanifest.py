@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+""" Records what a backup partition should contain - the type, permissions,
+ownership, size and SHA-256 of every entry - and checks a backup against
+that record.  Files are hashed as they are copied, or concurrently, one per
+CPU. """
+
+import os
+import stat
+import json
+import hashlib
+import threading
+import concurrent.futures
+
+from xcp import logger
+
+MANIFEST_FILE = '.xen-backup-manifest'
+MANIFEST_VERSION = 1
+
+HASH = hashlib.sha256
+HASH_CHUNK = 1024 * 1024
+
+# entries checked by a worker at once
+BATCH_ENTRIES = 64
+
+def hashFile(path, progress=lambda x: ()):
+    """ Returns the SHA-256 of the file at path as a hex string, calling
+    progress with the number of bytes hashed as it proceeds. """
+    h = HASH()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK)
+            if not data:
+                break
+            h.update(data)
+            progress(len(data))
+    return h.hexdigest()
+
+def _record(path, st):
+    """ Returns the manifest record for the entry at path, which has lstat
+    result st, without its digest. """
+    mode = st.st_mode
+    if stat.S_ISLNK(mode):
+        extra = os.readlink(path)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        extra = st.st_rdev
+    else:
+        extra = None
+    size = st.st_size if stat.S_ISREG(mode) else 0
+    # directories change as files are written into the backup after copying
+    mtime = None if stat.S_ISDIR(mode) else st.st_mtime_ns
+    return [stat.S_IFMT(mode), stat.S_IMODE(mode), st.st_uid, st.st_gid, size, mtime, extra]
+
+def _run(fn, work, progress):
+    """ Runs fn on each item of work in a pool of workers, calling progress
+    from this thread every half second.  Returns the results in order. """
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+        results = [pool.submit(fn, w) for w in work]
+        pending = results
+        while pending:
+            _, pending = concurrent.futures.wait(pending, timeout=0.5)
+            progress()
+        return [r.result() for r in results]
+
+class _Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.value += n
+
+def _batches(items):
+    for i in range(0, len(items), BATCH_ENTRIES):
+        yield items[i:i + BATCH_ENTRIES]
+
+class Manifest(object):
+    """ Maps the path of each entry of a backup, relative to its root, to a
+    record of [file type, permissions, uid, gid, size, mtime in nanoseconds
+    (of non-directories), SHA-256 for files, target for symlinks or device
+    number for devices]. """
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    @classmethod
+    def fromTree(cls, root, names, previous=None, progress=lambda done, total: ()):
+        """ Returns a Manifest of the entries names in root and everything
+        beneath them.  Digests are taken from previous, a Manifest, for files
+        which it records with the same size and mtime.  progress is called
+        with the number of bytes hashed so far and the total. """
+        entries = {}
+        to_hash = {}
+        stack = []
+
+        def visit(path, st):
+            record = _record(os.path.join(root, path), st)
+            entries[path] = record
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(path)
+            elif stat.S_ISREG(st.st_mode):
+                old = previous.entries.get(path) if previous else None
+                if old and old[:6] == record[:6]:
+                    record[6] = old[6]
+                else:
+                    # hard links are hashed once
+                    to_hash.setdefault((st.st_dev, st.st_ino), []).append(path)
+
+        for name in names:
+            visit(name, os.lstat(os.path.join(root, name)))
+        while stack:
+            path = stack.pop()
+            with os.scandir(os.path.join(root, path)) as it:
+                for entry in it:
+                    visit(os.path.join(path, entry.name), entry.stat(follow_symlinks=False))
+
+        work = list(to_hash.values())
+        total = sum(entries[paths[0]][4] for paths in work)
+        done = _Counter()
+        def hash_one(paths):
+            digest = hashFile(os.path.join(root, paths[0]), done.add)
+            for path in paths:
+                entries[path][6] = digest
+        logger.log("Hashing %d files (%d bytes) of %d entries in %s" % (len(work), total, len(entries), root))
+        _run(hash_one, work, lambda: progress(done.value, total))
+        return cls(entries)
+
+    @classmethod
+    def fromCopy(cls, copy, previous=None, progress=lambda done, total: ()):
+        """ Returns a Manifest of what copy, a treecopy.TreeCopy made with
+        hasher HASH which has been run, wrote.  Digests are those taken while
+        copying; for files the copy skipped as unchanged they are taken from
+        previous, a Manifest, if it records them the same, and otherwise by
+        hashing the destination.  progress is called with the number of
+        bytes hashed so far and the total. """
+        entries = {}
+        to_hash = []
+        for path, st in copy.dirs + copy.entries:
+            record = _record(os.path.join(copy.src, path), st)
+            entries[path] = record
+            if record[0] != stat.S_IFREG:
+                continue
+            if path in copy.digests:
+                record[6] = copy.digests[path]
+                continue
+            old = previous.entries.get(path) if previous else None
+            if path in copy.skipped and old and old[:6] == record[:6]:
+                record[6] = old[6]
+            else:
+                to_hash.append(path)
+
+        total = sum(entries[path][4] for path in to_hash)
+        done = _Counter()
+        def hash_one(path):
+            entries[path][6] = hashFile(os.path.join(copy.dst, path), done.add)
+        logger.log("Hashing %d files (%d bytes) of %d entries in %s" % (len(to_hash), total, len(entries), copy.dst))
+        _run(hash_one, to_hash, lambda: progress(done.value, total))
+
+        # hard links share the record of the entry they link to
+        for path, target in copy.links:
+            entries[path] = list(entries[target])
+        return cls(entries)
+
+    def update(self, root, path):
+        """ Records the entry path in root again, after it has changed. """
+        full = os.path.join(root, path)
+        record = _record(full, os.lstat(full))
+        if record[0] == stat.S_IFREG:
+            record[6] = hashFile(full)
+        self.entries[path] = record
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION, 'entries': len(self.entries)}) + '\n')
+            for entry_path in sorted(self.entries):
+                f.write(json.dumps([entry_path] + self.entries[entry_path]) + '\n')
+
+    @classmethod
+    def read(cls, path):
+        """ Returns the Manifest in the file path.  Raises ValueError if it
+        cannot be understood. """
+        entries = {}
+        with open(path, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != MANIFEST_VERSION:
+                raise ValueError("Unknown manifest version %s" % header.get('version'))
+            for line in f:
+                record = json.loads(line)
+                entries[record[0]] = record[1:]
+        if len(entries) != header.get('entries'):
+            raise ValueError("Manifest %s is truncated" % path)
+        return cls(entries)
+
+    def verify(self, root, full=True, progress=lambda done, total: ()):
+        """ Checks the entries in root against the manifest, hashing files too
+        if full is set.  Returns a list of the paths which are missing or
+        differ.  progress is called with the amount of work done so far and
+        the total: bytes hashed if full, otherwise entries checked. """
+        paths = sorted(self.entries)
+        if full:
+            total = sum(self.entries[p][4] for p in paths if self.entries[p][0] == stat.S_IFREG)
+        else:
+            total = len(paths)
+        done = _Counter()
+
+        def check(path):
+            record = self.entries[path]
+            full_path = os.path.join(root, path)
+            try:
+                actual = _record(full_path, os.lstat(full_path))
+                if actual[:6] != record[:6]:
+                    return False
+                if record[0] != stat.S_IFREG:
+                    return actual[6] == record[6]
+                return not full or hashFile(full_path, done.add) == record[6]
+            except EnvironmentError:
+                return False
+
+        def check_batch(batch):
+            bad = [path for path in batch if not check(path)]
+            if not full:
+                done.add(len(batch))
+            return bad
+
+        results = _run(check_batch, list(_batches(paths)), lambda: progress(done.value, total))
+        problems = [path for bad in results for path in bad]
+        if problems:
+            logger.log("%d entries of %s differ from its manifest, including %s" %
+                       (len(problems), root, ', '.join(problems[:10])))
+        return problems
+
+def readManifest(root):
+    """ Returns the Manifest of the backup mounted at root, or None if it
+    has none (as backups made by older installers do not). """
+    path = os.path.join(root, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    return Manifest.read(path)
@@ -121,6 +121,7 @@ ANSWERFILE_PATH = '/tmp/answerfile'
 ANSWERFILE_GENERATOR_PATH = '/tmp/answerfile_generator'
 SCRIPTS_DIR = "/tmp/scripts"
 EXTRA_SCRIPTS_DIR = "/tmp/extra-scripts"
+INSTALL_PROFILE = "/tmp/install-profile.json"
 defaults_data_file = '/opt/xensource/installer/defaults.json'
 SYSFS_IBFT_DIR = "/sys/firmware/ibft"
 
@@ -169,6 +170,34 @@ ISCSI_NODES = 'var/lib/iscsi/nodes'
 CC_PREPARATIONS = False
 CC_FIREWALL_CONF = '/opt/xensource/installer/common_criteria_firewall_rules'
 
+# run independent install steps concurrently (see backend.executeSequence)
+PARALLEL_TASKS = False
+PARALLEL_TASK_WORKERS = 4
+
+# directory in which to remember packages which passed repository
+# verification (see repository.VerificationCache), or None
+VERIFICATION_CACHE_DIR = None
+
+# number of devices searched for repositories at once (see
+# repository.findRepositoriesOnMedia)
+MEDIA_SCAN_WORKERS = 8
+
+# number of disks probed for existing installations at once (see
+# diskutil.probeDisks)
+DISK_PROBE_WORKERS = 8
+
+# number of workers copying files at once during backup and restore (see
+# treecopy.copyTree)
+COPY_WORKERS = 8
+
+# bring an existing backup of the installation being upgraded up to date
+# instead of reformatting the backup partition
+INCREMENTAL_BACKUP = False
+
+# copy the blocks in use by the root filesystem to the backup partition,
+# and back on restore, instead of copying files
+IMAGE_BACKUP = False
+
 # list of dom0 services that will be disabled for common criteria preparation,
 # and these can be overridden by answer file
 SERVICES = ["sshd"]
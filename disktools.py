@@ -2,6 +2,11 @@
 
 import constants
 import re, subprocess, types, os, time
+import struct, uuid, zlib
+import fcntl
+import json
+import threading
+import bisect
 from pprint import pprint
 from copy import copy, deepcopy
 import util
@@ -91,6 +96,7 @@ class LVMTool:
     VG_EXT_SR_PREFIX = 'XSLocalEXT'
 
     PVMOVE = ['pvmove']
+    PVMOVE_MAX_RANGES = 32 # Source ranges moved by a single pvmove command
     LVCHANGE = ['lvchange']
     LVREMOVE = ['lvremove']
     VGCHANGE = ['vgchange']
@@ -124,6 +130,15 @@ class LVMTool:
         'integer_options' : ['pe_start', 'pv_size', 'pv_free', 'pv_pe_count', 'dev_size']
     }
 
+    # All of the above in one command, keyed by fullreport subreport name
+    FULLREPORT = ['/sbin/lvm', 'fullreport', '--reportformat', 'json', '--nosuffix', '--units', 'b']
+    FULLREPORT_INFO = [('vg', VGS_INFO), ('lv', LVS_INFO), ('seg', LVS_SEG_INFO), ('pv', PVS_INFO)]
+
+    # The LVM configuration, shared by all LVMTools until it is changed
+    _snapshot = None
+    _snapshotGeneration = None
+    _snapshotLock = threading.Lock()
+
     def __init__(self):
         self.readAllInfo()
         self.pvsToDelete = []
@@ -169,18 +184,101 @@ class LVMTool:
 
         return retVal
 
-    def readAllInfo(self):
-        self.vgs = self.readInfo(self.VGS_INFO)
-        self.lvs = self.readInfo(self.LVS_INFO)
-        self.lvSegs = self.readInfo(self.LVS_SEG_INFO)
-        self.pvs = self.readInfo(self.PVS_INFO)
+    def readFullReport(self):
+        """Read the records of VGS_INFO, LVS_INFO, LVS_SEG_INFO and PVS_INFO
+        with a single 'lvm fullreport', so that devices are only scanned once.
+        Returns a dict of lists of records keyed by subreport name, or None if
+        this version of LVM cannot do so."""
+        cmd = list(self.FULLREPORT)
+        for name, info in self.FULLREPORT_INFO:
+            cmd += ['--configreport', name, '--options', ','.join(info['string_options'] + info['integer_options'])]
+        rv, out, err = util.runCmd2(cmd, True, True)
+        if rv != 0:
+            logger.log("lvm fullreport failed, falling back to separate reports: %s" % str(err).strip())
+            return None
+
+        try:
+            reports = json.loads(out)['report']
+        except (ValueError, KeyError, TypeError) as e:
+            logger.log("Could not decode lvm fullreport output: %s" % str(e))
+            return None
+
+        retVal = {}
+        for name, info in self.FULLREPORT_INFO:
+            allOptions = info['string_options'] + info['integer_options']
+            records = []
+            for report in reports:
+                for line in report.get(name, []):
+                    try:
+                        data = dict((option, line[option]) for option in allOptions)
+                        for option in info['integer_options']:
+                            # Convert integer options to integer type
+                            data[option] = int(data[option])
+                        records.append(data)
+                    except Exception as e:
+                        logger.log("Discarding corrupt LVM record '"+str(line)+"'")
+                        logger.log("  Error was '"+str(e)+"'")
+            retVal[name] = records
+        # fullreport includes LVM's internal orphan VGs
+        retVal['vg'] = [vg for vg in retVal['vg'] if vg['vg_name'] and not vg['vg_name'].startswith('#')]
+        return retVal
+
+    def readConfiguration(self):
+        """Read the LVM configuration, returning (vgs, lvs, lvSegs, pvs)."""
+        report = self.readFullReport()
+        if report is not None:
+            vgs, lvs, lvSegs, pvs = report['vg'], report['lv'], report['seg'], report['pv']
+        else:
+            vgs = self.readInfo(self.VGS_INFO)
+            lvs = self.readInfo(self.LVS_INFO)
+            lvSegs = self.readInfo(self.LVS_SEG_INFO)
+            pvs = self.readInfo(self.PVS_INFO)
         # For DM nodes "pvs" incorrectly returns /dev/dm-n, which does not exist.
         # Replace occurrences of /dev/dm-n with the correct node under /dev/mapper/
-        for pv in self.pvs:
+        for pv in pvs:
             name = pv['pv_name']
             if name.startswith('/dev/dm-'):
                 n = int(name[8:])
                 pv['pv_name'] = getDeviceMapperNode(n)
+        return (vgs, lvs, lvSegs, pvs)
+
+    @classmethod
+    def invalidateSnapshot(cls):
+        """Discard the shared LVM configuration.  commit() does this, but it
+        must also be called after changing LVM configuration by other means."""
+        with cls._snapshotLock:
+            LVMTool._snapshot = None
+
+    def readAllInfo(self):
+        # Reuse the configuration read by another LVMTool unless LVM or the
+        # block devices have changed since.
+        with self._snapshotLock:
+            if LVMTool._snapshot is None or LVMTool._snapshotGeneration != util.blockDeviceGeneration():
+                LVMTool._snapshot = self.readConfiguration()
+                LVMTool._snapshotGeneration = util.blockDeviceGeneration()
+            # Each LVMTool annotates its own records, so hand out copies
+            self.vgs, self.lvs, self.lvSegs, self.pvs = deepcopy(LVMTool._snapshot)
+        self.buildIndexes()
+
+    def buildIndexes(self):
+        """Index the records just read, so that lookups don't have to scan
+        every PV, LV or segment.  Indexed lists keep LVM's order."""
+        self.pvsByName = {}
+        # Positions in self.pvs of the PVs in each list of pvsByName
+        self.pvOrdinalsByName = {}
+        for ordinal, pv in enumerate(self.pvs):
+            self.pvsByName.setdefault(pv['pv_name'], []).append(pv)
+            self.pvOrdinalsByName.setdefault(pv['pv_name'], []).append(ordinal)
+        self.pvNames = sorted(self.pvsByName.keys())
+
+        self.lvsByName = {}
+        self.lvsByVG = {}
+        for lv in self.lvs:
+            self.lvsByName.setdefault(lv['lv_name'], lv)
+            self.lvsByVG.setdefault(lv['vg_name'], []).append(lv)
+
+        # Built on first use by segmentList, as decoding can fail
+        self.segmentsByDevice = None
 
     @classmethod
     def decodeSegmentRange(cls, segRange):
@@ -203,16 +301,24 @@ class LVMTool:
         retVal = device+':'+str(start)+'-'+str(endInclusive)
         return retVal
 
+    @classmethod
+    def encodeSegmentRanges(cls, device, ranges):
+        # Several ranges on one device, e.g. '/dev/sdb3:0-15:32-47', given (start, size) pairs
+        encoded = [cls.encodeSegmentRange(device, start, size) for start, size in ranges]
+        return device+''.join(segRange[len(device):] for segRange in encoded)
+
     def segmentList(self, device):
-        # PV segments don't record whether the segment is free space or not, so iterate through
+        # PV segments don't record whether the segment is free space or not, so use
         # the LV segments for the device instead
-        segments = []
-        for lvSeg in self.lvSegs:
-            segRange = self.decodeSegmentRange(lvSeg['seg_pe_ranges'])
-            if segRange['device'] == device:
-                segments.append(Segment(segRange['start'], segRange['size']))
-        segments.sort(key=lambda x: x.start)
-        return segments
+        if self.segmentsByDevice is None:
+            segmentsByDevice = {}
+            for lvSeg in self.lvSegs:
+                segRange = self.decodeSegmentRange(lvSeg['seg_pe_ranges'])
+                segmentsByDevice.setdefault(segRange['device'], []).append(Segment(segRange['start'], segRange['size']))
+            for segments in segmentsByDevice.values():
+                segments.sort(key=lambda x: x.start)
+            self.segmentsByDevice = segmentsByDevice
+        return [Segment(seg.start, seg.size) for seg in self.segmentsByDevice.get(device, [])]
 
     def freeSegmentList(self, device):
         pv = self.deviceToPV(device)
@@ -283,10 +389,8 @@ class LVMTool:
     def deviceToPVOrNone(self, device):
         """ Returns the PV record for a given device (partition), or None if there is no PV
         for that device."""
-        for pv in self.pvs:
-            if pv['pv_name'] == device:
-                return pv
-        return None
+        pvs = self.pvsByName.get(device)
+        return pvs[0] if pvs else None
 
     def deviceToPV(self, device):
         pv = self.deviceToPVOrNone(device)
@@ -295,10 +399,10 @@ class LVMTool:
         return pv
 
     def vGContainingLV(self, lvol):
-        for lv in self.lvs:
-            if lv['lv_name'] == lvol:
-                return lv['vg_name']
-        raise Exception("VG for LV '"+lvol+"' not found")
+        lv = self.lvsByName.get(lvol)
+        if lv is None:
+            raise Exception("VG for LV '"+lvol+"' not found")
+        return lv['vg_name']
 
     def deviceSize(self, device):
         pv = self.deviceToPV(device)
@@ -329,11 +433,18 @@ class LVMTool:
     def testPartition(self, devicePrefix, vgPrefix):
         """Returns the first partition where the device name starts with devicePrefix and
         the volume group that it's in starts with vgPrefix"""
+        # Names starting with devicePrefix are adjacent in sorted order; of
+        # their PVs, return the first in LVM's order as a scan would
         retVal = None
-        for pv in self.pvs:
-            if pv['pv_name'].startswith(devicePrefix) and pv['vg_name'].startswith(vgPrefix):
-                retVal = pv['pv_name']
+        first = None
+        for name in self.pvNames[bisect.bisect_left(self.pvNames, devicePrefix):]:
+            if not name.startswith(devicePrefix):
                 break
+            for index, pv in zip(self.pvOrdinalsByName[name], self.pvsByName[name]):
+                if pv['vg_name'].startswith(vgPrefix):
+                    if first is None or index < first:
+                        retVal, first = name, index
+                    break
         return retVal
 
     def configPartition(self, devicePrefix):
@@ -371,13 +482,12 @@ class LVMTool:
         vgsToDelete = []
         lvsToDelete = []
 
-        for pv in self.pvs:
-            if pv['pv_name'] == device:
-                pvsToDelete.append(pv['pv_name'])
-                vgsToDelete.append(pv['vg_name'])
+        for pv in self.pvsByName.get(device, []):
+            pvsToDelete.append(pv['pv_name'])
+            vgsToDelete.append(pv['vg_name'])
 
-        for lv in self.lvs:
-            if lv['vg_name'] in vgsToDelete:
+        for vg in vgsToDelete:
+            for lv in self.lvsByVG.get(vg, []):
                 # lvremove requires a 'path': <VG name>/<LV name>
                 lvsToDelete.append(lv['vg_name']+'/'+lv['lv_name'])
 
@@ -400,31 +510,62 @@ class LVMTool:
             except Exception as e:
                 logger.logException(e)
 
+    @classmethod
+    def coalesceMoves(cls, moveList):
+        """Returns a new MoveList in which each MoveChunk that carries on from the previous
+        one, in both source and destination, is merged into it"""
+        coalesced = []
+        for move in moveList:
+            last = coalesced[-1] if coalesced else None
+            if last and last.src + last.size == move.src and last.dest + last.size == move.dest:
+                last.size += move.size
+            else:
+                coalesced.append(MoveChunk(move.src, move.dest, move.size))
+        return coalesced
+
+    @classmethod
+    def pvmoveWithProgress(cls, params, progress_callback):
+        """Runs pvmove, passing the percentage it reports having moved to progress_callback"""
+        matchProgress = re.compile(r'.*Moved:\s*([\d.]+)%')
+        util.countSubprocess()
+        process = subprocess.Popen(cls.PVMOVE + ['--interval', '1'] + params,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        output = []
+        for line in process.stdout:
+            output.append(line)
+            matches = matchProgress.match(line)
+            if matches:
+                progress_callback(float(matches.group(1)))
+        rv = util.waitSubprocess(process)
+        if rv != 0:
+            raise Exception(''.join(output)+"\nError="+str(rv))
+
     @classmethod
     def executeMoves(cls, progress_callback, device, moveList):
         # Call commit instead this method unless you have special requirements
         """Issues pvmove commands to move MoveChunks specified by the MoveList.  Doesn't
         handle overlapping source and destination segments in a single MoveChunk, but in
-        a makeSpaceAtEnd scenario those aren't generated"""
-        sizeStep = 16 # Moving 16 extents takes only slightly more time than moving 1
-        totalExtents = sum(move.size for move in moveList)
+        a makeSpaceAtEnd scenario those aren't generated.  Contiguous MoveChunks are moved
+        together, and each pvmove moves up to PVMOVE_MAX_RANGES of them"""
+        moves = cls.coalesceMoves(moveList)
+        totalExtents = sum(move.size for move in moves)
         extentsSoFar = 0
-        for move in moveList:
-            offset = 0
-            while offset < move.size:
-                progress_callback((100 * extentsSoFar) / totalExtents)
-                chunkSize = min(sizeStep, move.size - offset)
-                srcRange = cls.encodeSegmentRange(device, move.src + offset, chunkSize)
-                destRange = cls.encodeSegmentRange(device, move.dest + offset, chunkSize)
-                cls.cmdWrap(cls.PVMOVE +
-                    [
-                    '--alloc',
-                    'anywhere',
-                    srcRange,
-                    destRange
-                ])
-                offset += chunkSize
-                extentsSoFar += chunkSize
+        for i in range(0, len(moves), cls.PVMOVE_MAX_RANGES):
+            batch = moves[i:i+cls.PVMOVE_MAX_RANGES]
+            batchExtents = sum(move.size for move in batch)
+            progress_callback((100 * extentsSoFar) / totalExtents)
+            srcRange = cls.encodeSegmentRanges(device, [(move.src, move.size) for move in batch])
+            destRange = cls.encodeSegmentRanges(device, [(move.dest, move.size) for move in batch])
+            batchProgress = lambda percent: progress_callback((100 * extentsSoFar + batchExtents * percent) / totalExtents)
+            cls.pvmoveWithProgress(
+                [
+                '--alloc',
+                'anywhere',
+                srcRange,
+                destRange
+            ], batchProgress)
+            extentsSoFar += batchExtents
 
     def commit(self, progress_callback=lambda _ : ()):
         """Commit the changes queued up by issuing LVM commands, delete our queues as they
@@ -469,6 +610,7 @@ class LVMTool:
             self.cmdWrap(self.PVRESIZE + ['--setphysicalvolumesize', str(resize['bytesize']/1024)+'k', resize['device']])
         self.resizeList = []
 
+        self.invalidateSnapshot()
         self.readAllInfo() # Reread the new LVM configuration
         progress_callback(99)
         self.deactivateAll() # Stop active LVs preventing changes to the partition structure
@@ -503,6 +645,46 @@ def partitionDevice(device, deviceNum):
     return device + determineMidfix(device) + str(deviceNum)
 
 
+# Disk details and partition tables already read, keyed by device.  An entry
+# is only used while the block device generation (see
+# util.blockDevicesChanged) and the device's fingerprint are unchanged.
+_partitionTableCache = {}
+_partitionTableCacheLock = threading.Lock()
+
+def deviceFingerprint(device):
+    """Returns a cheap summary of device from sysfs (its size, partitions and
+    holders), or None if sysfs does not describe it."""
+    name = os.path.basename(os.path.realpath(device))
+    sysdir = '/sys/class/block/' + name
+    try:
+        with open(os.path.join(sysdir, 'size')) as f:
+            size = f.read().strip()
+        partitions = sorted(x for x in os.listdir(sysdir) if x.startswith(name))
+        holders = sorted(os.listdir(os.path.join(sysdir, 'holders')))
+    except (IOError, OSError):
+        return None
+    return (size, tuple(partitions), tuple(holders))
+
+def cachedPartitionTable(device, partTableType=None):
+    """Returns (partTableType, state) cached for device, or None."""
+    with _partitionTableCacheLock:
+        entry = _partitionTableCache.get(device)
+    if entry is None:
+        return None
+    generation, fingerprint, cachedType, state = entry
+    if generation != util.blockDeviceGeneration() or fingerprint != deviceFingerprint(device) or \
+            (partTableType is not None and partTableType != cachedType):
+        return None
+    return cachedType, state
+
+def invalidatePartitionTableCache(device=None):
+    """Forget what is cached for device, or for all devices."""
+    with _partitionTableCacheLock:
+        if device is None:
+            _partitionTableCache.clear()
+        else:
+            _partitionTableCache.pop(device, None)
+
 class PartitionToolBase:
     """
     Base class for the DOS and GPT Partition Tool classes.
@@ -512,11 +694,26 @@ class PartitionToolBase:
 
     DEFAULT_SECTOR_SIZE = 512 # Used if sfdisk won't print its (hardcoded) value
 
+    # Attributes set by readDiskDetails and partitionTable, which are cached
+    CACHED_ATTRIBUTES = ['sectorSize', 'sectorExtent', 'sectorFirstUsable', 'sectorLastUsable', 'partitions']
+
     def __init__(self, device):
         self.device = device
         self.midfix = determineMidfix(device)
-        self.readDiskDetails()
-        self.partitions = self.partitionTable()
+        cached = cachedPartitionTable(device, self.partTableType)
+        if cached:
+            self.__dict__.update(deepcopy(cached[1]))
+        else:
+            # Taken before reading, so that a change while reading leaves
+            # the entry stale rather than recording the old table as current
+            generation = util.blockDeviceGeneration()
+            fingerprint = deviceFingerprint(device)
+            self.readDiskDetails()
+            self.partitions = self.partitionTable()
+            if fingerprint is not None:
+                state = dict((name, getattr(self, name)) for name in self.CACHED_ATTRIBUTES)
+                with _partitionTableCacheLock:
+                    _partitionTableCache[device] = (generation, fingerprint, self.partTableType, deepcopy(state))
         self.origPartitions = deepcopy(self.partitions)
 
     def partitionNumber(self, partitionDevice):
@@ -549,25 +746,46 @@ class PartitionToolBase:
         except:
             logger.log('udevsettle with %d second timeout failed' % timeout)
 
-    def waitForDeviceNodes(self):
+    def waitForDeviceNodes(self, monitor=None):
         # Ensure new device nodes are available before we continue.
-        # Wait a second to ensure that udev picks up the change event from
-        # the kernel, then call settle to wait for all events complete.
-        time.sleep(1)
-        self.settleUdev()
+        # Settle, then allow up to a second for udev to pick up and handle
+        # any change events from the kernel.  monitor, opened before the
+        # partition table was touched, also catches the events sent since.
+        util.waitForUdev(self.settleUdev, 1, subsystem='block', monitor=monitor)
+
+    def writeAndWait(self, cmd):
+        # Run a command which changes the partition table, then wait for
+        # the events it causes to be handled.
+        monitor = util.UeventMonitor.open()
+        try:
+            out = self.cmdWrap(cmd)
+            self.waitForDeviceNodes(monitor)
+        finally:
+            if monitor:
+                monitor.close()
+            util.blockDevicesChanged()
+        return out
 
     def writePartitionTable(self, dryrun=False, log=False):
+        invalidatePartitionTableCache(self.device)
+        monitor = util.UeventMonitor.open()
         try:
-            self.writeThisPartitionTable(self.partitions, dryrun, log)
-        except Exception as e:
             try:
-                # Revert to the original partition table
-                self.writeThisPartitionTable(self.origPartitions, dryrun)
-            except Exception as e2:
-                raise Exception('The new partition table could not be written: '+str(e)+'\nReversion also failed: '+str(e2))
-            raise Exception('The new partition table could not be written but was reverted successfully: '+str(e))
-        else:
-            self.waitForDeviceNodes()
+                self.writeThisPartitionTable(self.partitions, dryrun, log)
+            except Exception as e:
+                try:
+                    # Revert to the original partition table
+                    self.writeThisPartitionTable(self.origPartitions, dryrun)
+                except Exception as e2:
+                    raise Exception('The new partition table could not be written: '+str(e)+'\nReversion also failed: '+str(e2))
+                raise Exception('The new partition table could not be written but was reverted successfully: '+str(e))
+            else:
+                self.waitForDeviceNodes(monitor)
+        finally:
+            if monitor:
+                monitor.close()
+            if not dryrun:
+                util.blockDevicesChanged()
 
     # Public methods from here onward:
     def getPartition(self, number, default=None):
@@ -731,6 +949,50 @@ class DOSPartitionTool(PartitionToolBase):
     SFDISK = '/sbin/sfdisk'
     partTableType = constants.PARTITION_DOS
 
+    # ioctls, from linux/hdreg.h and linux/fs.h
+    HDIO_GETGEO = 0x0301
+    BLKSSZGET = 0x1268
+    BLKGETSIZE64 = 0x80081272
+
+    # On-disk MBR structures
+    MBR_ENTRY = struct.Struct('<B3sB3sII') # status, CHS first, type, CHS last, LBA first, sectors
+    MBR_TABLE_OFFSET = 446
+    MBR_SIGNATURE = b'\x55\xaa'
+    MBR_BOOTABLE = 0x80
+    EXTENDED_IDS = [0x05, 0x0f, 0x85]
+
+    def __readNativeDiskDetails(self):
+        # Read the geometry and sector size as sfdisk does, but directly from
+        # the kernel.  Returns False if the device does not support it.
+        try:
+            with open(self.device, 'rb') as f:
+                geometry = fcntl.ioctl(f, self.HDIO_GETGEO, bytes(struct.calcsize('BBHL')))
+                sectorSize = fcntl.ioctl(f, self.BLKSSZGET, bytes(struct.calcsize('i')))
+                sizeBytes = fcntl.ioctl(f, self.BLKGETSIZE64, bytes(struct.calcsize('Q')))
+        except (IOError, OSError) as e:
+            logger.log("Could not read geometry of %s: %s" % (self.device, str(e)))
+            return False
+        heads, sectors, _cylinders, _start = struct.unpack('BBHL', geometry)
+        if heads == 0 or sectors == 0:
+            return False
+
+        # The cylinder count in the ioctl is only 16 bits, so calculate it
+        # from the size in 512 byte units as sfdisk does
+        cylinders = struct.unpack('Q', sizeBytes)[0] // 512 // (heads * sectors)
+        self.sectorExtent = cylinders * heads * sectors
+
+        # DOS partition tables have 32bit sector addresses so we may need to truncate sectorExtent
+        # Actually truncate a bit more because sfdisk has unfathomablely lower limit
+        self.sectorExtent = min([self.sectorExtent, 0xffe00000]) # 2047G
+        cylinders = int(self.sectorExtent/(heads * sectors))
+        self.sectorExtent = cylinders * heads * sectors # Ignore partial cylinder at end
+
+        self.sectorFirstUsable = sectors # Some SANs require bootable disks to start on sector boundary
+        self.sectorLastUsable = self.sectorExtent - 1
+
+        self.sectorSize = struct.unpack('i', sectorSize)[0]
+        return True
+
     def __readDiskDetails(self):
         # Read basic geometry
         out = self.cmdWrap([self.SFDISK, '-Lg', self.device])
@@ -785,10 +1047,73 @@ class DOSPartitionTool(PartitionToolBase):
     def readDiskDetails(self):
         if isDeviceMapperNode(self.device):
             self.__readDeviceMapperDiskDetails()
-        else:
+        elif not self.__readNativeDiskDetails():
             self.__readDiskDetails()
 
+    def readMBR(self):
+        """Read the MBR, and any chain of EBRs, directly from the device.
+        Returns the partitions in the form partitionTable does, or None if
+        there is no MBR."""
+        def readTable(f, sector):
+            f.seek(sector * self.sectorSize)
+            data = f.read(512)
+            if len(data) != 512 or data[510:512] != self.MBR_SIGNATURE:
+                return None
+            return [self.MBR_ENTRY.unpack_from(data, self.MBR_TABLE_OFFSET + i * self.MBR_ENTRY.size)
+                    for i in range(4)]
+
+        partitions = {}
+        try:
+            with open(self.device, 'rb') as f:
+                entries = readTable(f, 0)
+                if entries is None:
+                    return None
+
+                extended = None
+                for number, (status, _, idt, _, start, size) in enumerate(entries, 1):
+                    if size == 0: # Treat partitions of size 0 as not present
+                        continue
+                    partitions[number] = {
+                        'start': start,
+                        'size': size,
+                        'id': idt,
+                        'active': status == self.MBR_BOOTABLE
+                        }
+                    if idt in self.EXTENDED_IDS and extended is None:
+                        extended = start
+
+                # Logical partitions are numbered from 5, following the chain
+                # of EBRs.  Each holds a partition relative to the EBR itself
+                # and a link relative to the start of the extended partition.
+                number = 5
+                ebr = extended
+                seen = set()
+                while ebr is not None and ebr not in seen:
+                    seen.add(ebr)
+                    entries = readTable(f, ebr)
+                    if entries is None:
+                        break
+                    status, _, idt, _, start, size = entries[0]
+                    if size != 0:
+                        partitions[number] = {
+                            'start': ebr + start,
+                            'size': size,
+                            'id': idt,
+                            'active': status == self.MBR_BOOTABLE
+                            }
+                        number += 1
+                    _, _, idt, _, start, size = entries[1]
+                    ebr = extended + start if size != 0 and idt in self.EXTENDED_IDS else None
+        except (IOError, OSError) as e:
+            logger.log("Could not read MBR from %s: %s" % (self.device, str(e)))
+            return None
+        return partitions
+
     def partitionTable(self):
+        partitions = self.readMBR()
+        if partitions is not None:
+            return partitions
+
         out = self.cmdWrap([self.SFDISK, '-Ld', self.device])
         state = 0
         partitions = {}
@@ -825,10 +1150,10 @@ class DOSPartitionTool(PartitionToolBase):
         return partitions
 
     def commitActivePartitiontoDisk(self, part_num):
+        invalidatePartitionTableCache(self.device)
         self.settleUdev()
         # BIOS bootable flag set for one and unset for others partition
-        self.cmdWrap([self.SFDISK, '--no-reread', '-A', self.device, part_num])
-        self.waitForDeviceNodes()
+        self.writeAndWait([self.SFDISK, '--no-reread', '-A', self.device, part_num])
 
     def writeThisPartitionTable(self, table, dryrun=False, log=False):
         cmd_input = 'unit: sectors\n\n'
@@ -865,6 +1190,7 @@ class DOSPartitionTool(PartitionToolBase):
             cmd = [self.SFDISK, dryrun and '-LnuS' or '-LuS', '--no-reread', '-f', self.device]
         logger.log('sfdisk command: %s' % ' '.join(cmd))
         self.settleUdev()
+        util.countSubprocess()
         process = subprocess.Popen(
             cmd,
             stdin=subprocess.PIPE,
@@ -931,18 +1257,86 @@ class GPTPartitionTool(PartitionToolBase):
     SGDISK = 'sgdisk'
     partTableType = constants.PARTITION_GPT
 
+    # On-disk GPT structures, see the UEFI specification
+    GPT_SIGNATURE = b'EFI PART'
+    GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+    GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+    GPT_ATTR_LEGACY_BIOS_BOOTABLE = 1 << 2
+
     def readDiskDetails(self):
         self.sectorSize        = int(self.cmdWrap(['blockdev', '--getss', self.device]))
         self.sectorExtent      = int(self.cmdWrap(['blockdev', '--getsize64', self.device])) / self.sectorSize
         self.sectorFirstUsable = 34
         self.sectorLastUsable  = self.sectorExtent - 34
 
+    def readGPT(self):
+        """Read the primary GPT directly from the device.  Returns the
+        partitions in the form partitionTable does, or None if there is no
+        valid GPT (e.g. it is missing or fails its CRC check)."""
+        try:
+            with open(self.device, 'rb') as f:
+                f.seek(self.sectorSize)
+                header = f.read(self.sectorSize)
+                if len(header) < self.GPT_HEADER.size:
+                    return None
+                (signature, _revision, header_size, header_crc, _reserved, current_lba,
+                 _backup_lba, _first_usable, _last_usable, _disk_guid, entries_lba,
+                 num_entries, entry_size, entries_crc) = self.GPT_HEADER.unpack_from(header)
+                if signature != self.GPT_SIGNATURE or current_lba != 1 or \
+                        not self.GPT_HEADER.size <= header_size <= self.sectorSize or \
+                        entry_size < self.GPT_ENTRY.size or num_entries * entry_size > 1024 * 1024:
+                    return None
+                # The header CRC is calculated with the CRC field zeroed
+                if zlib.crc32(header[:16] + b'\0' * 4 + header[20:header_size]) != header_crc:
+                    return None
+
+                f.seek(entries_lba * self.sectorSize)
+                entries = f.read(num_entries * entry_size)
+                if len(entries) != num_entries * entry_size or zlib.crc32(entries) != entries_crc:
+                    return None
+        except (IOError, OSError) as e:
+            logger.log("Could not read GPT from %s: %s" % (self.device, str(e)))
+            return None
+
+        partitions = {}
+        for i in range(num_entries):
+            (type_guid, unique_guid, first_lba, last_lba, attributes,
+             name) = self.GPT_ENTRY.unpack_from(entries, i * entry_size)
+            if type_guid == b'\0' * 16:
+                continue
+            partitions[i + 1] = {
+                'start': first_lba,
+                'size': last_lba + 1 - first_lba,
+                'partlabel': name.decode('utf-16-le', 'replace').split('\0', 1)[0],
+                'active': bool(attributes & self.GPT_ATTR_LEGACY_BIOS_BOOTABLE),
+                'id': str(uuid.UUID(bytes_le=type_guid)).upper(),
+                'partuuid': str(uuid.UUID(bytes_le=unique_guid)).upper(),
+                }
+        return partitions
+
     def partitionTable(self):
+        # Read the GPT directly if we can.  This also avoids sgdisk opening
+        # the device for writing, so there is no need to wait for udev.
+        partitions = self.readGPT()
+        if partitions is not None:
+            return partitions
+
+        # sgdisk opens the device with O_WRONLY even when not changing anything
+        # so settle udev to ensure device nodes are available for subsequent
+        # commands, watching for the events that causes from the start.
+        monitor = util.UeventMonitor.open()
+        try:
+            return self.readPartitionTable(monitor)
+        finally:
+            if monitor:
+                monitor.close()
+
+    def readPartitionTable(self, monitor):
         cmd = [self.SGDISK, '--print', self.device]
         rv, out, err = util.runCmd2(cmd, True, True)
         if rv != 0:
             logger.log('Invalid or corrupt partition table found on disk %s. Skipping...' % self.device)
-            self.waitForDeviceNodes()
+            self.waitForDeviceNodes(monitor)
             return {}
 
         matchWarning   = re.compile('Found invalid GPT and valid MBR; converting MBR to GPT format.')
@@ -991,20 +1385,18 @@ class GPTPartitionTool(PartitionToolBase):
                     partitions[number]['partuuid'] = m.group(1)
             assert 'id' in partitions[number]
 
-        # sgdisk opens the device with O_WRONLY even when not changing anything
-        # so settle udev to ensure device nodes are available for subsequent
-        # commands.
-        self.waitForDeviceNodes()
+        self.waitForDeviceNodes(monitor)
         return partitions
 
     def commitActivePartitiontoDisk(self, partnum):
+        invalidatePartitionTableCache(self.device)
+        cmd = [self.SGDISK]
         for num, part in self.items():
             if num == partnum:
-                self.cmdWrap([self.SGDISK, '--attributes=%d:set:2' % num, self.device]) # BIOS bootable flag set
+                cmd.append('--attributes=%d:set:2' % num) # BIOS bootable flag set
             else:
-                self.cmdWrap([self.SGDISK, '--attributes=%d:clear:2' % num, self.device]) # BIOS bootable flag clear
-
-        self.waitForDeviceNodes()
+                cmd.append('--attributes=%d:clear:2' % num) # BIOS bootable flag clear
+        self.writeAndWait(cmd + [self.device])
 
     def writeThisPartitionTable(self, table, dryrun=False, log=False):
         for part in table.values():
@@ -1031,7 +1423,30 @@ class GPTPartitionTool(PartitionToolBase):
         except:
             # Ignore error code which results from inconsistent initial state
             pass
-        self.cmdWrap([self.SGDISK, '--mbrtogpt', '--clear', self.device])
+        # Write the whole table in one go: sgdisk applies its options in
+        # order and saves once, so udev sees a single change.
+        cmd = [self.SGDISK, '--mbrtogpt', '--clear']
+
+        # Ensure that we write out in on-disk order to prevent conflicts when
+        # partition sizes get rounded.
+        items = sorted(table.items(), key=lambda item: item[1]['start'])
+        for num,part in items:
+            start  = part['start']
+            end    = part['size'] + start - 1
+            idt    = part['id']
+            active = part['active']
+            cmd.append('--new=%d:%d:%d' % (num,start,end))
+            cmd.append('--typecode=%d:%s' % (num,self.GUID_to_type_code[idt]))
+            if active:
+                cmd.append('--attributes=%d:set:2' % num) # BIOS bootable flag
+            if 'partlabel' in part and part['partlabel']:
+                cmd.append('--change-name=%d:%s' % (num, part['partlabel']))
+            if 'partuuid' in part:
+                cmd.append('--partition-guid=%d:%s' % (num, part['partuuid']))
+        cmd.append(self.device)
+        if log:
+            logger.log('sgdisk command: %s' % ' '.join(cmd))
+        self.cmdWrap(cmd)
 
         has_esp = False
         for part in table.values():
@@ -1048,23 +1463,6 @@ class GPTPartitionTool(PartitionToolBase):
             self.settleUdev()
             self.cmdWrap(['sfdisk', '--no-reread', '-A', self.device, '1'])
 
-        # Ensure that we write out in on-disk order to prevent conflicts when
-        # partition sizes get rounded.
-        items = sorted(table.items(), key=lambda item: item[1]['start'])
-        for num,part in items:
-            start  = part['start']
-            end    = part['size'] + start - 1
-            idt    = part['id']
-            active = part['active']
-            self.cmdWrap([self.SGDISK, '--new=%d:%d:%d' % (num,start,end), self.device])
-            self.cmdWrap([self.SGDISK, '--typecode=%d:%s' % (num,self.GUID_to_type_code[idt]), self.device])
-            if active:
-                self.cmdWrap([self.SGDISK, '--attributes=%d:set:2' % num, self.device]) # BIOS bootable flag
-            if 'partlabel' in part and part['partlabel']:
-                self.cmdWrap([self.SGDISK, '--change-name=%d:%s' % (num, part['partlabel']), self.device])
-            if 'partuuid' in part:
-                self.cmdWrap([self.SGDISK, '--partition-guid=%d:%s' % (num, part['partuuid']), self.device])
-
         if isDeviceMapperNode(self.device):
             # Create partitions using device mapper
             rv = createPartnodes(self.device)
@@ -1093,7 +1491,8 @@ def PartitionTool(device, partitionType=None):
     system currently in use on device
     """
     if partitionType is None:
-        partitionType = probePartitioningScheme(device)
+        cached = cachedPartitionTable(device)
+        partitionType = cached[0] if cached else probePartitioningScheme(device)
     if partitionType == constants.PARTITION_DOS:
         return DOSPartitionTool(device)
     elif partitionType == constants.PARTITION_GPT:
@@ -1106,6 +1505,7 @@ def destroyPartnodes(dev):
     for partition in partitions:
         # the obvious way to do this is to use "kpartx -d" but that's broken!
         rv = util.runCmd2(['dmsetup', 'remove', partition])
+        util.blockDevicesChanged()
         if rv: return rv
     return 0
 
@@ -1118,10 +1518,14 @@ def destroyMpathPartnodes():
 
 def createPartnodes(dev):
     # Create partition nodes for a device-mapper device
-    return util.runCmd2(['kpartx', '-a', dev])
+    rv = util.runCmd2(['kpartx', '-a', dev])
+    util.blockDevicesChanged()
+    return rv
 
 def createMpathPartnodes():
-    return util.runCmd2(['dmsetup', 'ls', '--target', 'multipath', '--exec', "kpartx -a"])
+    rv = util.runCmd2(['dmsetup', 'ls', '--target', 'multipath', '--exec', "kpartx -a"])
+    util.blockDevicesChanged()
+    return rv
 
 def getMpathNodes():
     nodes = []
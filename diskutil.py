@@ -1,6 +1,8 @@
 # SPDX-License-Identifier: GPL-2.0-only
 
 import re, sys
+import struct
+import concurrent.futures
 import os.path
 import errno
 import constants
@@ -43,6 +45,7 @@ def mpath_part_scan(force=False):
     ret = createMpathPartnodes()
     if ret == 0:
          util.runCmd2(util.udevsettleCmd())
+         util.blockDevicesChanged()
     return ret
 
 def mpath_enable():
@@ -56,6 +59,7 @@ def mpath_enable():
     util.runCmd2(["/sbin/multipath", "-v0", "-B"])
     time.sleep(1)
     util.runCmd2(util.udevsettleCmd())
+    util.blockDevicesChanged()
 
     # This creates maps for all disks at start of day (because -e is ommitted)
     assert 0 == util.runCmd2('multipathd -d > /var/log/multipathd 2>&1 &')
@@ -72,6 +76,7 @@ def mpath_disable():
     destroyMpathPartnodes()
     util.runCmd2(['killall','multipathd'])
     util.runCmd2(['/sbin/multipath','-F'])
+    util.blockDevicesChanged()
     use_mpath = False
 
 # hd* -> (ide has majors 3, 22, 33, 34, 56, 57, 88, 89, 90, 91, each major has
@@ -113,7 +118,46 @@ for major in list(range(72, 80)) + list(range(104, 112)):
 for major in range(48, 56):
     disk_nodes += [ (major, x * 8) for x in range(32) ]
 
+class BlockDeviceInventory(object):
+    """The disks, partitions and removable devices on the host, each scanned
+    from /proc/partitions and sysfs on first use.  Use inventory() to obtain
+    an up to date instance."""
+
+    def __init__(self):
+        self.generation = util.blockDeviceGeneration()
+        self._disks = None
+        self._partitions = {}
+        self._removable = None
+
+    def disks(self):
+        if self._disks is None:
+            self._disks = _scanDiskList()
+        return self._disks
+
+    def partitionsOnDisk(self, disk):
+        if disk not in self._partitions:
+            self._partitions[disk] = _scanPartitionsOnDisk(disk)
+        return self._partitions[disk]
+
+    def removableDevices(self):
+        if self._removable is None:
+            self._removable = _scanRemovableDeviceList()
+        return self._removable
+
+_inventory = None
+
+def inventory():
+    """Return the current BlockDeviceInventory, taking a new one if block
+    devices have changed (see util.blockDevicesChanged) since the last."""
+    global _inventory
+    if _inventory is None or _inventory.generation != util.blockDeviceGeneration():
+        _inventory = BlockDeviceInventory()
+    return _inventory
+
 def getDiskList():
+    return list(inventory().disks())
+
+def _scanDiskList():
     # read the partition tables:
     parts = open("/proc/partitions")
     partlines = [re.sub(" +", " ", x).strip() for x in parts.readlines()]
@@ -162,6 +206,9 @@ def getPartitionList():
 def partitionsOnDisk(disk):
     if disk.startswith('/dev/'):
         disk = disk[5:]
+    return list(inventory().partitionsOnDisk(disk))
+
+def _scanPartitionsOnDisk(disk):
     if isDeviceMapperNode('/dev/' + disk):
         name = disk.split('/',1)[1]
         partitions = [s for s in os.listdir('/dev/mapper/') if re.match(name + r'p?\d+$', s)]
@@ -180,6 +227,9 @@ def getQualifiedPartitionList():
     return [getQualifiedDeviceName(x) for x in getPartitionList()]
 
 def getRemovableDeviceList():
+    return list(inventory().removableDevices())
+
+def _scanRemovableDeviceList():
     devs = os.listdir('/sys/block')
     removable_devs = []
     for d in devs:
@@ -196,7 +246,7 @@ def removable(device):
     if device.startswith('scd'):
         device = 'sr'+device[3:]
 
-    return device in getRemovableDeviceList()
+    return device in inventory().removableDevices()
 
 def getQualifiedDeviceName(disk):
     return "/dev/%s" % disk
@@ -357,6 +407,50 @@ def readExtPartitionLabel(partition):
         raise Exception("%s is not ext partition" % partition)
     return label
 
+# Filesystems identified by filesystemType
+KNOWN_FILESYSTEMS = ['iso9660', 'vfat', 'ext2', 'ext3', 'ext4']
+
+EXT_SUPER_MAGIC = 0xEF53
+EXT3_FEATURE_COMPAT_HAS_JOURNAL = 0x4
+EXT3_FEATURE_INCOMPAT_SUPP = 0x1e   # filetype, recover, journal_dev, meta_bg
+EXT3_FEATURE_RO_COMPAT_SUPP = 0x7   # sparse_super, large_file, btree_dir
+
+def filesystemType(device):
+    """Identify the filesystem on device from its superblock, without
+    mounting it or running blkid.  Returns one of KNOWN_FILESYSTEMS, or None
+    if none of them is found.  Raises IOError if device cannot be read."""
+    with open(device, 'rb') as f:
+        data = f.read(34 * 1024)
+
+    # The primary volume descriptor starts at sector 16
+    if data[32769:32774] == b'CD001':
+        return 'iso9660'
+
+    sb = data[1024:2048]
+    if len(sb) == 1024 and struct.unpack_from('<H', sb, 56)[0] == EXT_SUPER_MAGIC:
+        compat, incompat, ro_compat = struct.unpack_from('<III', sb, 92)
+        if incompat & ~EXT3_FEATURE_INCOMPAT_SUPP or ro_compat & ~EXT3_FEATURE_RO_COMPAT_SUPP:
+            return 'ext4'
+        if compat & EXT3_FEATURE_COMPAT_HAS_JOURNAL:
+            return 'ext3'
+        return 'ext2'
+
+    if data[510:512] == b'\x55\xaa' and isFATBootSector(data[:512]):
+        return 'vfat'
+
+    return None
+
+def isFATBootSector(sector):
+    """Check the BIOS parameter block of a FAT boot sector.  The type strings
+    at offsets 54 and 82 are only labels, and may be anything or blank."""
+    bytes_per_sector, sectors_per_cluster, reserved_sectors, fats = \
+        struct.unpack_from('<HBHB', sector, 11)
+    media = sector[21]
+    return bytes_per_sector in (512, 1024, 2048, 4096) and \
+        sectors_per_cluster in (1, 2, 4, 8, 16, 32, 64, 128) and \
+        reserved_sectors >= 1 and fats in (1, 2) and \
+        (media == 0xf0 or media >= 0xf8)
+
 def getMdDeviceName(disk):
     rv, out = util.runCmd2(['mdadm', '--detail', '--export', disk],
                            with_stdout=True)
@@ -451,10 +545,12 @@ INSTALL_RETAIL = 1
 STORAGE_LVM = 1
 STORAGE_EXT3 = 2
 
-def probeDisk(device, justInstall=False):
+def probeDisk(device, justInstall=False, lv_tool=None):
     """Examines device and reports the apparent presence of a XenServer installation and/or related usage
     Returns a tuple (boot, state, storage)
 
+    lv_tool is an LVMTool to consult; one is created if needed and not given.
+
     Where:
 
         boot is a tuple of True or False and the partition device
@@ -498,7 +594,8 @@ def probeDisk(device, justInstall=False):
             boot = (True, part_device)
 
     if not justInstall:
-        lv_tool = len(possible_srs) and LVMTool()
+        if lv_tool is None:
+            lv_tool = len(possible_srs) and LVMTool()
         for num in possible_srs:
             part_device = tool._partitionDevice(num)
 
@@ -518,6 +615,16 @@ def probeDisk(device, justInstall=False):
     return (boot, root, state, storage, logs)
 
 
+def probeDisks(devices, justInstall=False):
+    """Probe each of devices as probeDisk does, but concurrently and sharing a
+    single LVMTool.  Returns the results in the same order as devices."""
+    if len(devices) == 0:
+        return []
+    lv_tool = None if justInstall else LVMTool()
+    with concurrent.futures.ThreadPoolExecutor(min(constants.DISK_PROBE_WORKERS, len(devices))) as executor:
+        return list(executor.map(lambda device: probeDisk(device, justInstall, lv_tool), devices))
+
+
 # Keep track of iscsi disks we have logged into
 iscsi_disks = []
 # Keep track of NICs reserved for iSCSI boot
@@ -720,12 +827,19 @@ def process_ibft(ui, interactive):
     setup_ibft_nics()
 
     # Attach disks
-    rv = util.runCmd2(['iscsistart', '-b'])
-    if rv:
-        raise RuntimeError('Failed to attach iSCSI target disk(s)')
-
+    monitor = util.UeventMonitor.open()
+    try:
+        rv = util.runCmd2(['iscsistart', '-b'])
+        if rv:
+            raise RuntimeError('Failed to attach iSCSI target disk(s)')
+
+        # Wait for the disks to appear
+        wait_for_iscsi_disks(targets, monitor, 5)
+    finally:
+        if monitor:
+            monitor.close()
     util.runCmd2(util.udevsettleCmd())
-    time.sleep(5)
+    util.blockDevicesChanged()
 
     rv, out = util.runCmd2([ 'iscsiadm', '-m', 'session', '-P', '3' ],
                            with_stdout=True)
@@ -740,10 +854,43 @@ def process_ibft(ui, interactive):
     logger.log('process_ibft: Reserved NICs: %s' % (str(list(ibft_reserved_nics)),))
 
 
+def iscsi_session_disks():
+    """Return the names of the block devices of each iSCSI session, from sysfs."""
+
+    disks = {}
+    for session in glob.glob('/sys/class/iscsi_session/session*'):
+        disks[os.path.basename(session)] = [
+            os.path.basename(b) for b in
+            glob.glob(os.path.join(session, 'device', 'target*', '*', 'block', '*'))]
+    return disks
+
+
+def wait_for_iscsi_disks(sessions, monitor, timeout):
+    """Wait, for at most timeout seconds, until at least sessions iSCSI
+    sessions have block devices, and their device nodes exist.  monitor is a
+    UeventMonitor, created before logging in, or None to poll."""
+
+    deadline = time.time() + timeout
+    while True:
+        ready = [s for s, names in iscsi_session_disks().items()
+                 if names and all(os.path.exists('/dev/' + n) for n in names)]
+        if len(ready) >= sessions:
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logger.log("Timed out waiting for iSCSI disks: %d of %d sessions ready" % (len(ready), sessions))
+            return False
+        if monitor:
+            monitor.receive(min(remaining, 0.5))
+        else:
+            time.sleep(min(remaining, 0.1))
+
+
 def release_ibft_disks():
     if util.pidof('iscsid'):
         util.runCmd2([ '/sbin/iscsiadm', '-m', 'session', '-u'])
         util.runCmd2([ '/sbin/iscsiadm', '-k', '0'])
+        util.blockDevicesChanged()
         iscsi_disks = []
 
 
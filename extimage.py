@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+""" Images ext2/ext3 filesystems block for block, reading the block bitmaps
+so that only blocks which the filesystem has in use are copied. """
+
+import os
+import time
+import struct
+
+import util
+import treecopy
+from xcp import logger
+
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 1024
+EXT_SUPER_MAGIC = 0xEF53
+EXT2_VALID_FS = 0x1
+EXT2_ERROR_FS = 0x2
+EXT3_FEATURE_INCOMPAT_RECOVER = 0x4
+EXT2_FEATURE_INCOMPAT_META_BG = 0x10
+# incompatible features which may be present: filetype, needs_recovery,
+# journal_dev, meta_bg - the same set diskutil.filesystemType accepts as ext3
+EXT3_FEATURE_INCOMPAT_SUPP = 0x1e
+# read-only compatible features which may be present: sparse_super,
+# large_file, btree_dir.  Others (e.g. uninit_bg, whose uninitialised groups
+# have no valid block bitmap) mean this is not plain ext3.
+EXT3_FEATURE_RO_COMPAT_SUPP = 0x7
+GROUP_DESC_SIZE = 32
+
+# used extents separated by no more than this many free bytes are copied as
+# one, keeping the I/O sequential
+MERGE_GAP = 256 * 1024
+
+class ExtFilesystem(object):
+    """ The layout of an ext2 or ext3 filesystem, read from its superblock. """
+
+    def __init__(self, device):
+        self.device = device
+        with open(device, 'rb') as f:
+            f.seek(SUPERBLOCK_OFFSET)
+            sb = f.read(SUPERBLOCK_SIZE)
+        if len(sb) < SUPERBLOCK_SIZE or struct.unpack_from('<H', sb, 56)[0] != EXT_SUPER_MAGIC:
+            raise IOError("%s does not contain an ext filesystem" % device)
+        (self.blocks_count, _, self.free_blocks_count, _, self.first_data_block,
+         log_block_size, _, self.blocks_per_group) = struct.unpack_from('<4xIIIIIIII', sb, 0)
+        self.state = struct.unpack_from('<H', sb, 58)[0]
+        self.feature_incompat, self.feature_ro_compat = struct.unpack_from('<II', sb, 96)
+        self.block_size = 1024 << log_block_size
+        self.groups = (self.blocks_count - self.first_data_block + self.blocks_per_group - 1) // self.blocks_per_group
+        self.size = self.blocks_count * self.block_size
+
+    def unsupportedReason(self):
+        """ Returns why the filesystem cannot be imaged, or None if it can. """
+        if self.feature_incompat & ~EXT3_FEATURE_INCOMPAT_SUPP or \
+                self.feature_ro_compat & ~EXT3_FEATURE_RO_COMPAT_SUPP:
+            return "it is not ext2 or ext3"
+        if self.feature_incompat & EXT2_FEATURE_INCOMPAT_META_BG:
+            return "it uses meta_bg"
+        if self.feature_incompat & EXT3_FEATURE_INCOMPAT_RECOVER:
+            return "its journal needs recovery"
+        if not self.state & EXT2_VALID_FS or self.state & EXT2_ERROR_FS:
+            return "it was not cleanly unmounted"
+        return None
+
+    def usedExtents(self, f):
+        """ Yields (offset, length) in bytes of the runs of blocks in use,
+        read from the block bitmaps through file object f. """
+        f.seek((self.first_data_block + 1) * self.block_size)
+        descs = f.read(self.groups * GROUP_DESC_SIZE)
+
+        runs = []
+        def add(block, end):
+            if runs and (block - runs[-1][1]) * self.block_size <= MERGE_GAP:
+                runs[-1][1] = end
+            else:
+                runs.append([block, end])
+
+        # blocks before the first group (the boot block of 1k filesystems)
+        if self.first_data_block:
+            add(0, self.first_data_block)
+
+        for group in range(self.groups):
+            bitmap_block = struct.unpack_from('<I', descs, group * GROUP_DESC_SIZE)[0]
+            f.seek(bitmap_block * self.block_size)
+            bitmap = f.read(self.block_size)
+            first = self.first_data_block + group * self.blocks_per_group
+            count = min(self.blocks_per_group, self.blocks_count - first)
+            for j in range((count + 7) // 8):
+                byte = bitmap[j]
+                if byte == 0:
+                    continue
+                if byte == 0xff:
+                    add(first + 8 * j, first + min(8 * j + 8, count))
+                    continue
+                for i in range(8 * j, min(8 * j + 8, count)):
+                    if byte & (1 << (i & 7)):
+                        add(first + i, first + i + 1)
+            # yield as we go, keeping the run which may still grow
+            while len(runs) > 1:
+                start, end = runs.pop(0)
+                yield start * self.block_size, (end - start) * self.block_size
+        for start, end in runs:
+            yield start * self.block_size, (end - start) * self.block_size
+
+def deviceSize(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+def imageable(src, dst):
+    """ Returns True if the filesystem on src can be imaged onto dst. """
+    try:
+        fs = ExtFilesystem(src)
+        reason = fs.unsupportedReason()
+        if not reason and fs.size > deviceSize(dst):
+            reason = "%s is too small" % dst
+    except EnvironmentError as e:
+        reason = str(e)
+    if reason:
+        logger.log("Cannot image %s: %s" % (src, reason))
+        return False
+    return True
+
+def imageFilesystem(src, dst, progress=lambda done, total: ()):
+    """ Copies the blocks in use by the ext2/ext3 filesystem on src to the
+    same offsets on dst, then gives the copy a new UUID and no label so that
+    it cannot be mistaken for the original.  progress is called with the
+    number of bytes copied so far and the total. """
+    fs = ExtFilesystem(src)
+    with open(src, 'rb') as f:
+        extents = list(fs.usedExtents(f))
+    total = sum(length for _, length in extents)
+    logger.log("Imaging %s to %s: %d bytes in %d extents" % (src, dst, total, len(extents)))
+
+    done = [0]
+    reported = [0]
+    def count(n):
+        done[0] += n
+        if time.time() - reported[0] >= 0.5:
+            reported[0] = time.time()
+            progress(done[0], total)
+
+    infd = os.open(src, os.O_RDONLY)
+    try:
+        outfd = os.open(dst, os.O_WRONLY)
+        try:
+            for offset, length in extents:
+                treecopy.copyRange(infd, outfd, offset, length, count)
+            os.fsync(outfd)
+            progress(done[0], total)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+    if util.runCmd2(['tune2fs', '-U', 'random', '-L', '', dst]) != 0:
+        raise RuntimeError("Failed to set new identity of %s" % dst)
@@ -86,6 +86,7 @@ def start_fcoe(interfaces):
     # of seconds for FCoE to stabilize.
     time.sleep(30)
     util.runCmd2(util.udevsettleCmd())
+    util.blockDevicesChanged()
     for interface, status in result.items():
         if status == 'OK':
             logger.log(get_luns_on_intf(interface))
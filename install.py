@@ -128,6 +128,14 @@ def go(ui, args, answerfile_address, answerfile_script):
         elif opt == "--cc-preparations":
             constants.CC_PREPARATIONS = True
             results['network-backend'] = constants.NETWORK_BACKEND_BRIDGE
+        elif opt == "--parallel-tasks":
+            constants.PARALLEL_TASKS = True
+        elif opt == "--verification-cache":
+            constants.VERIFICATION_CACHE_DIR = val
+        elif opt == "--incremental-backup":
+            constants.INCREMENTAL_BACKUP = True
+        elif opt == "--image-backup":
+            constants.IMAGE_BACKUP = True
 
     if boot_console and not serial_console:
         serial_console = boot_console
@@ -184,8 +192,8 @@ def go(ui, args, answerfile_address, answerfile_script):
                 if 'fcoe-interfaces' in results:
                     fcoeutil.start_fcoe(results['fcoe-interfaces'])
 
-                util.runCmd2(util.udevsettleCmd())
-                time.sleep(1)
+                util.waitForUdev(lambda: util.runCmd2(util.udevsettleCmd()), 1)
+                util.blockDevicesChanged()
                 diskutil.mpath_part_scan()
 
                 # ensure partitions/disks are not locked by LVM
@@ -246,9 +254,9 @@ def go(ui, args, answerfile_address, answerfile_script):
                     pd = tui.progress.initProgressDialog("Restoring %s" % backup,
                                                          "Restoring data - this may take a while...",
                                                          100)
-                def progress(x):
+                def progress(x, text=None):
                     if ui and pd:
-                        tui.progress.displayProgressDialog(x, pd)
+                        tui.progress.displayProgressDialog(x, pd, updated_text=text)
                 restore.restoreFromBackup(backup, progress)
                 if ui:
                     tui.progress.clearModelessDialog()
@@ -140,8 +140,8 @@ def setAllLinksUp():
         if nif not in diskutil.ibft_reserved_nics:
             subprocs.append(subprocess.Popen(['ip', 'link', 'set', nif, 'up'], close_fds=True))
 
-    while None in [x.poll() for x in subprocs]:
-        time.sleep(1)
+    for x in subprocs:
+        x.wait()
 
 def networkingUp():
     rc, out = util.runCmd2(['ip', 'route'], with_stdout=True)
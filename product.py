@@ -11,6 +11,7 @@ import version
 import re
 import stat
 import repository
+import backupmanifest
 from disktools import *
 import hardware
 import xcp
@@ -533,13 +534,21 @@ def findXenSourceBackups():
     for p in partitions:
         b = None
         try:
+            # Backup partitions are always ext3, don't try to mount anything else
+            if diskutil.filesystemType(p) != 'ext3':
+                continue
             b = util.TempMount(p, 'backup-', ['ro'], 'ext3')
             if os.path.exists(os.path.join(b.mount_point, '.xen-backup-partition')):
                 backup = XenServerBackup(p, b.mount_point)
                 logger.log("Found a backup: %s" % (repr(backup),))
                 if backup.version >= XENSERVER_MIN_VERSION and \
                         backup.version <= THIS_PLATFORM_VERSION:
-                    backups.append(backup)
+                    # a quick check: restore hashes the files too
+                    manifest = backupmanifest.readManifest(b.mount_point)
+                    if manifest and manifest.verify(b.mount_point, full=False):
+                        logger.log("Ignoring backup on %s which does not match its manifest" % p)
+                    else:
+                        backups.append(backup)
         except:
             pass
         if b:
@@ -556,9 +565,8 @@ def findXenSourceProducts():
 
     installs = []
 
-    for disk in diskutil.getQualifiedDiskList():
-        (boot, root, state, storage, logs) = diskutil.probeDisk(disk)
-
+    disks = diskutil.getQualifiedDiskList()
+    for disk, (boot, root, state, storage, logs) in zip(disks, diskutil.probeDisks(disks)):
         inst = None
         try:
             if root[0] == diskutil.INSTALL_RETAIL:
@@ -2,17 +2,23 @@
 
 import os
 import os.path
+import stat
 import glob
 import errno
 import hashlib
 import tempfile
-import urllib.request, urllib.parse
+import urllib.request, urllib.parse, urllib.error
+import http.client
+import base64
+import threading
 import ftplib
 import subprocess
 import re
 import gzip
 import shutil
-from xml.dom.minidom import parse
+import concurrent.futures
+import json
+from xml.etree import ElementTree
 
 import diskutil
 import hardware
@@ -22,6 +28,7 @@ from util import dev_null
 from xcp.version import *
 from xcp import logger
 import cpiofile
+import constants
 from constants import *
 import xml.dom.minidom
 import configparser
@@ -56,28 +63,44 @@ class Repository(object):
         return self._accessor
 
     def check(self, progress=lambda x: ()):
-        """ Return a list of problematic packages. """
-        def pkg_progress(start, end):
-            def progress_fn(x):
-                progress(start + ((x * (end - start)) / 100))
-            return progress_fn
-
+        """ Return a list of problematic packages.  Packages are hashed
+        concurrently, one per CPU, while progress is reported from the
+        calling thread. """
         self._accessor.start()
 
         try:
-            problems = []
-            total_size = sum((p.size for p in self._packages))
-            total_progress = 0
-            for p in self._packages:
-                start = (total_progress * 100) / total_size
-                end = ((total_progress + p.size) * 100) / total_size
-                if not p.check(False, pkg_progress(start, end)):
-                    problems.append(p)
-                total_progress += p.size
+            total_size = sum((p.size for p in self._packages)) or 1
+            # Percentage of each package checked so far, updated by the workers
+            pkg_done = [0] * len(self._packages)
+
+            def pkg_progress(i):
+                def progress_fn(x):
+                    pkg_done[i] = x
+                return progress_fn
+
+            def overall_progress():
+                return sum(pkg_done[i] * p.size for i, p in enumerate(self._packages)) / total_size
+
+            cache = self.verificationCache()
+            with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+                results = [pool.submit(p.check, False, pkg_progress(i), cache)
+                           for i, p in enumerate(self._packages)]
+                pending = results
+                while pending:
+                    _, pending = concurrent.futures.wait(pending, timeout=0.5)
+                    progress(overall_progress())
+                problems = [p for p, r in zip(self._packages, results) if not r.result()]
+            if cache:
+                cache.save()
         finally:
             self._accessor.finish()
         return problems
 
+    def verificationCache(self):
+        """ Returns the VerificationCache for this repository, or None if
+        verification results are not to be kept. """
+        return None
+
     def __iter__(self):
         return self._packages.__iter__()
 
@@ -117,10 +140,17 @@ class YumRepository(Repository):
     def _repo_config(self):
         return None
 
+    def verificationCache(self):
+        if not constants.VERIFICATION_CACHE_DIR:
+            return None
+        return VerificationCache(constants.VERIFICATION_CACHE_DIR, self._repomd_checksum)
+
     def _parse_repodata(self, accessor):
         # Read packages from xml
-        repomdfp = accessor.openAddress(self.REPOMD_FILENAME)
-        repomd_xml = parse(repomdfp)
+        repomdfp = accessor.openAddress(self.REPOMD_FILENAME, mode="rb")
+        repomd_data = repomdfp.read()
+        self._repomd_checksum = hashlib.sha256(repomd_data).hexdigest()
+        repomd_xml = xml.dom.minidom.parseString(repomd_data)
         xml_datas = repomd_xml.getElementsByTagName("data")
         for data_node in xml_datas:
             data = data_node.getAttribute("type")
@@ -133,26 +163,44 @@ class YumRepository(Repository):
         # Open compressed xml using cpiofile._Stream which is an adapter between CpioFile and a stream-like object.
         # Useful when specifying the URL for HTTP or FTP repository - A simple GzipFile object will not work in this situation.
         primary_xml = cpiofile._Stream("", "r", "gz", primaryfp, 20*512)
-        primary_dom = parse(primary_xml)
-        package_names = primary_dom.getElementsByTagName("location")
-        package_sizes = primary_dom.getElementsByTagName("size")
-        package_checksums = primary_dom.getElementsByTagName("checksum")
-        primary_xml.close()
-        primaryfp.close()
-
-        # Filter using only sha256 checksum
-        sha256_checksums = [x for x in package_checksums if x.getAttribute("type") == "sha256"]
-
-        # After the filter, the list of checksums will have the same size
-        # of the list of names
-        self._packages = []
-        for name_node, size_node, checksum_node in zip(package_names, package_sizes, sha256_checksums):
-            name = name_node.getAttribute("href")
-            size = size_node.getAttribute("package")
-            checksum = checksum_node.childNodes[0]
-            pkg = RPMPackage(self, name, size, checksum.data)
+        try:
+            self._packages = list(self._iter_packages(primary_xml))
+        finally:
+            primary_xml.close()
+            primaryfp.close()
+
+    def _iter_packages(self, primary_xml):
+        """ Incrementally parse primary.xml, yielding an RPMPackage for each
+        <package> element.  Each element is discarded once handled so memory
+        use does not grow with the number of packages in the repository. """
+        def local_name(tag):
+            # Strip any namespace
+            return tag.rsplit('}', 1)[-1]
+
+        context = ElementTree.iterparse(primary_xml, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or local_name(elem.tag) != 'package':
+                continue
+
+            name, size, checksum = None, None, None
+            for child in elem:
+                tag = local_name(child.tag)
+                if tag == 'location':
+                    name = child.get('href')
+                elif tag == 'size':
+                    size = child.get('package')
+                elif tag == 'checksum' and child.get('type') == 'sha256':
+                    checksum = child.text.strip()
+            root.clear()
+
+            if name is None or size is None or checksum is None:
+                # Only sha256 checksums are supported
+                logger.log("Ignoring incomplete package entry in primary metadata: %s" % name)
+                continue
+            pkg = RPMPackage(self, name, size, checksum)
             pkg.type = 'rpm'
-            self._packages.append(pkg)
+            yield pkg
 
     def __repr__(self):
         return "%s@yum" % self._identifier
@@ -442,22 +490,29 @@ class RPMPackage(object):
         self.size = int(size)
         self.sha256sum = sha256sum
 
-    def check(self, fast=False, progress=lambda x : ()):
+    def check(self, fast=False, progress=lambda x : (), cache=None):
         """ Check a package against it's known checksum, or if fast is
-        specified, just check that the package exists. """
+        specified, just check that the package exists.  If a
+        VerificationCache is given, packages it already holds are not
+        checked again and packages found to be valid are added to it. """
         if fast:
             return self.repository.accessor().access(self.name)
         else:
             try:
+                mtime = self.repository.accessor().mtime(self.name)
+                if cache and cache.isVerified(self.name, self.size, mtime):
+                    logger.log("Package %s already validated" % self.name)
+                    progress(100)
+                    return True
+
                 logger.log("Validating package %s" % self.name)
-                namefp = self.repository.accessor().openAddress(self.name)
+                namefp = self.repository.accessor().openAddress(self.name, mode="rb")
                 m = hashlib.sha256()
-                data = ''
                 total_read = 0
                 while True:
                     data = namefp.read(10485760)
                     total_read += len(data)
-                    if data == '':
+                    if not data:
                         break
                     else:
                         m.update(data)
@@ -465,10 +520,50 @@ class RPMPackage(object):
                 namefp.close()
                 calculated = m.hexdigest()
                 valid = (self.sha256sum == calculated)
+                if valid and cache:
+                    cache.add(self.name, self.size, mtime)
                 return valid
             except Exception as e:
                 return False
 
+class VerificationCache(object):
+    """ Records the packages of a repository which have passed verification,
+    keyed on package name, size and modification time.  The cache is stored
+    in 'cache_dir' in a file named after the checksum of the repository
+    metadata, so that any change to the repository invalidates it. """
+
+    def __init__(self, cache_dir, repo_checksum):
+        self.path = os.path.join(cache_dir, repo_checksum + '.json')
+        self.verified = {}
+        self.dirty = False
+        try:
+            with open(self.path, 'r') as f:
+                self.verified = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.log("Ignoring verification cache %s: %s" % (self.path, e))
+        except ValueError as e:
+            logger.log("Ignoring corrupt verification cache %s: %s" % (self.path, e))
+
+    def isVerified(self, name, size, mtime):
+        return self.verified.get(name) == [size, mtime]
+
+    def add(self, name, size, mtime):
+        self.verified[name] = [size, mtime]
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            util.assertDir(os.path.dirname(self.path))
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.verified, f)
+            os.rename(self.path + '.tmp', self.path)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            logger.log("Failed to write verification cache %s: %s" % (self.path, e))
+
 class Accessor:
     def pathjoin(base, name):
         return os.path.join(base, name)
@@ -485,6 +580,11 @@ class Accessor:
         else:
             return True
 
+    def mtime(self, name):
+        """ Return the modification time of 'name', or None if it cannot be
+        determined. """
+        return None
+
     def canEject(self):
         return False
 
@@ -517,6 +617,12 @@ class FilesystemAccessor(Accessor):
     def openAddress(self, addr, mode="r"):
         return open(os.path.join(self.location, addr), mode)
 
+    def mtime(self, name):
+        try:
+            return int(os.stat(os.path.join(self.location, name)).st_mtime)
+        except OSError:
+            return None
+
     def url(self):
         return util.URL("file://%s" % self.location)
 
@@ -530,12 +636,34 @@ class MountingAccessor(FilesystemAccessor):
         self.start_count = 0
         self.location = None
 
+    def _candidateTypes(self):
+        """ Narrow mount_types down to the filesystem found on the device.
+        If none of them is found, nothing can be mounted unless mount_types
+        includes a type which cannot be identified, so only then are they
+        all tried.  An empty list means nothing can be mounted. """
+        try:
+            if not stat.S_ISBLK(os.stat(self.mount_source).st_mode):
+                return self.mount_types
+            fs = diskutil.filesystemType(self.mount_source)
+        except (IOError, OSError):
+            return self.mount_types
+
+        if fs in self.mount_types:
+            return [fs]
+        if all(x in diskutil.KNOWN_FILESYSTEMS for x in self.mount_types):
+            logger.log("No filesystem of type %s found on %s" % (', '.join(self.mount_types), self.mount_source))
+            return []
+        return self.mount_types
+
     def start(self):
         if self.start_count == 0:
+            mount_types = self._candidateTypes()
+            if not mount_types:
+                raise util.MountFailureException
             self.location = tempfile.mkdtemp(prefix="media-", dir="/tmp")
             # try each filesystem in turn:
             success = False
-            for fs in self.mount_types:
+            for fs in mount_types:
                 try:
                     util.mount(self.mount_source, self.location,
                                options=self.mount_options,
@@ -585,13 +713,165 @@ class NFSAccessor(MountingAccessor):
     def __init__(self, nfspath):
         MountingAccessor.__init__(self, ['nfs'], nfspath, ['ro', 'tcp'])
 
+class HTTPConnectionPool(object):
+    """ Keep-alive HTTP(S) connections, reused per host.  Safe for use from
+    several threads at once: each request takes an idle connection (or opens
+    a new one) and returns it to the pool once the response has been read. """
+
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+    def __init__(self, username=None, password=None):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._headers = {}
+        if username is not None:
+            credentials = "%s:%s" % (username, password or '')
+            self._headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+
+    def _split(url):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return (parts.scheme, parts.hostname, parts.port), path
+    _split = staticmethod(_split)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, hostname, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(hostname, port), False
+        return http.client.HTTPConnection(hostname, port), False
+
+    def release(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _request(self, method, url, headers=None):
+        key, path = self._split(url)
+        request_headers = dict(self._headers)
+        request_headers.update(headers or {})
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request(method, path, headers=request_headers)
+                return key, conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the server may have dropped an idle connection, in which
+                # case retry on another one
+                if not reused:
+                    raise
+
+    def _discard(self, key, conn, response):
+        response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+
+    def open(self, url, offset=0):
+        """ GET url, returning a file-like response.  If offset is non-zero
+        a range is requested, and None returned if the server ignores it. """
+        if offset:
+            key, conn, response = self._request('GET', url, {'Range': 'bytes=%d-' % offset})
+            if response.status == 200:
+                # the whole file is on its way: drop the connection rather
+                # than read it
+                response.close()
+                conn.close()
+                return None
+        else:
+            key, conn, response = self._request('GET', url)
+        if response.status == (206 if offset else 200):
+            return PooledResponse(self, key, conn, response)
+        self._discard(key, conn, response)
+        if response.status in self.REDIRECT_STATUSES:
+            # leave redirects, which may lead to another host, to urllib
+            return URLAccessor.urlopenRange(url, offset)
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    def head(self, url):
+        """ Issue a HEAD request for url, returning the status code. """
+        key, conn, response = self._request('HEAD', url)
+        self._discard(key, conn, response)
+        return response.status
+
+    def closeAll(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+class PooledResponse(object):
+    """ An HTTP response whose connection is returned to its pool when it is
+    closed, provided the body was read in full. """
+
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+class FTPFileWrapper:
+    "A binary RETR transfer, handing its FTP session to release when closed"
+
+    def __init__(self, ftp, conn, release):
+        self.ftp = ftp
+        self.conn = conn
+        self.fp = conn.makefile('rb')
+        self.release = release
+        self.eof = False
+
+    def read(self, *params):
+        ret_val = self.fp.read(*params)
+        if not ret_val or not params:
+            self.eof = True
+        return ret_val
+
+    def close(self):
+        self.fp.close()
+        self.conn.close()
+        # An aborted transfer leaves the session in an unknown state
+        if self.eof:
+            try:
+                self.ftp.voidresp()
+            except ftplib.all_errors:
+                self.ftp.close()
+            else:
+                self.release(self.ftp)
+        else:
+            self.ftp.close()
+
 class URLFileWrapper:
-    "This wrapper emulate seek (forwards) for URL streams"
+    """This wrapper emulate seek for URL streams.  If reopen is given it is
+    called as reopen(offset) to restart the transfer at offset (e.g. with an
+    HTTP Range request), returning None if the server cannot do so; otherwise
+    only forward seeks are possible, by reading and discarding data."""
     SEEK_SET = 0 # SEEK_CUR and SEEK_END not supported
+    SEEK_DISCARD_LIMIT = 1024 * 1024 # Shorter forward seeks read through
 
-    def __init__(self, delegate):
+    def __init__(self, delegate, reopen=None):
         self.delegate = delegate
         self.pos = 0
+        self.reopen = reopen
 
     def __getattr__(self, name):
         return getattr(self.delegate, name)
@@ -602,6 +882,21 @@ class URLFileWrapper:
         return ret_val
 
     def seek(self, offset, whence=0):
+        if whence == self.SEEK_SET and self.reopen and \
+                (offset < self.pos or offset - self.pos > self.SEEK_DISCARD_LIMIT):
+            try:
+                delegate = self.reopen(offset)
+            except Exception as e:
+                logger.log("Ranged request failed: %s" % str(e))
+                delegate = None
+            if delegate:
+                self.delegate.close()
+                self.delegate = delegate
+                self.pos = offset
+                return
+            # Not supported by the server, don't try again
+            self.reopen = None
+
         consume = 0
         if whence == self.SEEK_SET:
             if offset >= self.pos:
@@ -639,6 +934,20 @@ class URLAccessor(Accessor):
                 self.opener = urllib.request.build_opener(self.authhandler)
                 urllib.request.install_opener(self.opener)
 
+        # Reuse connections unless a proxy is configured, in which case
+        # leave everything to urllib.
+        self._pool = None
+        if self._url.getScheme() in ['http', 'https'] and \
+                self._url.getScheme() not in urllib.request.getproxies():
+            self._pool = HTTPConnectionPool(self._url.getUsername(), self._url.getPassword())
+
+        # FTP sessions and directory listings, kept between start() and
+        # finish()
+        self._ftp_lock = threading.Lock()
+        self._ftp_active = False
+        self._ftp_idle = []
+        self._ftp_listings = {}
+
         logger.log("Initializing URLRepositoryAccessor with base address %s" % str(self._url))
 
     def _url_concat(url1, end):
@@ -661,45 +970,160 @@ class URLAccessor(Accessor):
     _url_decode = staticmethod(_url_decode)
 
     def start(self):
-        pass
+        self._ftp_active = True
 
     def finish(self):
-        pass
+        if self._pool:
+            self._pool.closeAll()
+
+        with self._ftp_lock:
+            self._ftp_active = False
+            idle, self._ftp_idle = self._ftp_idle, []
+            self._ftp_listings = {}
+        for ftp in idle:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+    def _ftpAcquire(self):
+        """ Return an idle FTP session, or log in to a new one. """
+        with self._ftp_lock:
+            if self._ftp_idle:
+                return self._ftp_idle.pop()
+        ftp = ftplib.FTP(self._url.getHostname())
+        ftp.login(self._url.getUsername(), self._url.getPassword())
+        # Sessions are shared, so remember where relative paths start from
+        ftp.home = ftp.pwd()
+        return ftp
+
+    def _ftpRelease(self, ftp):
+        with self._ftp_lock:
+            if self._ftp_active:
+                self._ftp_idle.append(ftp)
+                return
+        ftp.close()
+
+    def _ftpCwd(self, ftp, directory):
+        ftp.cwd(os.path.join(ftp.home, directory))
+
+    def _ftpListing(self, directory):
+        """ Return the set of names in directory, cached until finish(). """
+        with self._ftp_lock:
+            if directory in self._ftp_listings:
+                return self._ftp_listings[directory]
+
+        ftp = self._ftpAcquire()
+        try:
+            self._ftpCwd(ftp, directory)
+            try:
+                names = set(os.path.basename(x) for x in ftp.nlst())
+            except ftplib.error_perm:
+                # Some servers refuse to list an empty directory
+                names = set()
+        except:
+            ftp.close()
+            raise
+        self._ftpRelease(ftp)
+
+        with self._ftp_lock:
+            if self._ftp_active:
+                self._ftp_listings[directory] = names
+        return names
+
+    def _ftpExists(self, directory, fname):
+        """ Ask the server whether fname is a file in directory.  Listings
+        may leave some files out (vsftpd hides dotfiles from NLST by
+        default), so this is used when fname is not listed. """
+        ftp = self._ftpAcquire()
+        try:
+            self._ftpCwd(ftp, directory)
+            try:
+                exists = ftp.size(fname) is not None
+            except ftplib.error_perm:
+                exists = False
+        except:
+            ftp.close()
+            raise
+        self._ftpRelease(ftp)
+
+        if exists:
+            with self._ftp_lock:
+                if directory in self._ftp_listings:
+                    self._ftp_listings[directory].add(fname)
+        return exists
+
+    def _ftpPath(self, path):
+        """ Split path into the server directory and file name. """
+        url = self._url_concat(self._url.getPlainURL(), path)
+        path = urllib.parse.urlsplit(url)[2]
+        return self._url_decode(os.path.dirname(path[1:])), os.path.basename(path)
+
+    def urlopenRange(url, offset):
+        """ urlopen, starting at offset if non-zero.  Returns None if the
+        server does not honour the range. """
+        if not offset:
+            return urllib.request.urlopen(url)
+        ret_val = urllib.request.urlopen(urllib.request.Request(url, headers={'Range': 'bytes=%d-' % offset}))
+        if ret_val.status != 206:
+            ret_val.close()
+            return None
+        return ret_val
+    urlopenRange = staticmethod(urlopenRange)
+
+    def _openRange(self, address, offset):
+        """ Reopen address at offset, or return None if not possible. """
+        scheme = self._url.getScheme()
+        if self._pool:
+            return self._pool.open(self._url_concat(self._url.getPlainURL(), address), offset)
+        elif scheme in ['http', 'https']:
+            return self.urlopenRange(self._url_concat(self._url.getPlainURL(), address), offset)
+        elif scheme == 'ftp':
+            directory, fname = self._ftpPath(address)
+            ftp = self._ftpAcquire()
+            try:
+                self._ftpCwd(ftp, directory)
+                ftp.voidcmd('TYPE I')
+                conn = ftp.transfercmd('RETR ' + fname, rest=offset)
+            except:
+                ftp.close()
+                raise
+            return FTPFileWrapper(ftp, conn, self._ftpRelease)
+        return None
 
     def access(self, path):
-        if not self._url.getScheme == 'ftp':
-            return Accessor.access(self, path)
+        if self._pool:
+            try:
+                status = self._pool.head(self._url_concat(self._url.getPlainURL(), path))
+            except:
+                return False
+            if status not in [405, 501] and status not in HTTPConnectionPool.REDIRECT_STATUSES:
+                return status == 200
+            # server does not support HEAD, or redirects: fall back to GET,
+            # which follows redirects
 
-        url = self._url_concat(self._url.getPlainURL(), path)
+        if self._url.getScheme() != 'ftp':
+            return Accessor.access(self, path)
 
         # if FTP, override by actually checking the file exists because urllib2 seems
         # to be not so good at this.
         try:
-            (scheme, netloc, path, params, query) = urllib.parse.urlsplit(url)
-            fname = os.path.basename(path)
-            directory = self._url_decode(os.path.dirname(path[1:]))
-            hostname = self._url.getHostname()
-            username = self._url.getUsername()
-            password = self._url.getPassword()
-
-            # now open a connection to the server and verify that fname is in
-            ftp = ftplib.FTP(hostname)
-            ftp.login(username, password)
-            ftp.cwd(directory)
-            if ftp.size(fname) is not None:
-                return True
-            lst = ftp.nlst()
-            return fname in lst
-        except:
-            # couldn't parse the server name out:
+            directory, fname = self._ftpPath(path)
+            return fname in self._ftpListing(directory) or self._ftpExists(directory, fname)
+        except ftplib.all_errors as e:
+            logger.log("FTP check for %s failed: %s" % (path, e))
             return False
 
-    def openAddress(self, address):
-        if self._url.getScheme() in ['http', 'https']:
+    def openAddress(self, address, mode="r"):
+        # mode is accepted for compatibility with FilesystemAccessor; URL
+        # streams are always binary.
+        if self._pool:
+            ret_val = self._pool.open(self._url_concat(self._url.getPlainURL(), address))
+        elif self._url.getScheme() in ['http', 'https']:
             ret_val = urllib.request.urlopen(self._url_concat(self._url.getPlainURL(), address))
         else:
             ret_val = urllib.request.urlopen(self._url_concat(self._url.getURL(), address))
-        return URLFileWrapper(ret_val)
+        return URLFileWrapper(ret_val, lambda offset: self._openRange(address, offset))
 
     def url(self):
         return self._url
@@ -728,6 +1152,11 @@ def repositoriesFromDefinition(media, address, drivers=False):
 def findRepositoriesOnMedia(drivers=False):
     """ Returns a list of repositories available on local media. """
 
+    # media may have been inserted since the last look (this is also how the
+    # retry screens look again), and inserting it need not reach the code
+    # which notices other changes to block devices
+    util.blockDevicesChanged()
+
     static_device_patterns = [ 'sd*', 'scd*', 'sr*', 'xvd*', 'nvme*n*', 'vd*' ]
     static_devices = []
     for pattern in static_device_patterns:
@@ -751,32 +1180,31 @@ def findRepositoriesOnMedia(drivers=False):
                 if dev not in parent_devices:
                     parent_devices.append(dev)
 
-    da = None
-    repos = []
-    try:
-        for check in parent_devices + partitions:
-            device_path = "/dev/%s" % check
-            logger.log("Looking for repositories: %s" % device_path)
-            if os.path.exists(device_path):
-                da = DeviceAccessor(device_path)
-                try:
-                    da.start()
-                except util.MountFailureException:
-                    da = None
-                    continue
-                else:
-                    if drivers:
-                        repo = da.findDriverRepository()
-                    else:
-                        repo = da.findRepository()
-                    if repo:
-                        repos.append(repo)
-                    da.finish()
-                    da = None
-    finally:
-        if da:
+    def probe(check):
+        device_path = "/dev/%s" % check
+        logger.log("Looking for repositories: %s" % device_path)
+        if not os.path.exists(device_path):
+            return None
+
+        da = DeviceAccessor(device_path)
+        try:
+            da.start()
+        except util.MountFailureException:
+            return None
+        try:
+            if drivers:
+                return da.findDriverRepository()
+            else:
+                return da.findRepository()
+        finally:
             da.finish()
 
+    # Results are returned in device order regardless of which probe
+    # finishes first.
+    devices = parent_devices + partitions
+    with concurrent.futures.ThreadPoolExecutor(max(1, min(constants.MEDIA_SCAN_WORKERS, len(devices)))) as executor:
+        repos = [repo for repo in executor.map(probe, devices) if repo]
+
     return repos
 
 def installFromYum(targets, mounts, progress_callback, cachedir):
@@ -786,6 +1214,7 @@ def installFromYum(targets, mounts, progress_callback, cachedir):
                        '--installroot', mounts['root'],
                        'install', '-y'] + targets
         logger.log("Running : %s" % ' '.join(dnf_cmd))
+        util.countSubprocess()
         p = subprocess.Popen(dnf_cmd, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
         count = 0
         total = 0
@@ -813,7 +1242,7 @@ def installFromYum(targets, mounts, progress_callback, cachedir):
             elif line.startswith('  Verifying  : '):
                 verify_count += 1
                 progress_callback(90 + int((verify_count * 10.0) / total))
-        rv = p.wait()
+        rv = util.waitSubprocess(p)
         stderr.seek(0)
         stderr = stderr.read()
         if stderr:
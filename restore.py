@@ -11,12 +11,16 @@ import constants
 import re
 import tempfile
 import shutil
+import treecopy
+import extimage
+import backupmanifest
 import xcp.bootloader as bootloader
 from xcp import logger
 
-def restoreFromBackup(backup, progress=lambda x: ()):
+def restoreFromBackup(backup, progress=lambda x, text=None: ()):
     """ Restore files from backup_partition to the root partition on disk.
-    Call progress with a value between 0 and 100.  Re-install bootloader.  Fails if
+    Call progress with a value between 0 and 100, and a description of the
+    copy's progress while files are restored.  Re-install bootloader.  Fails if
     backup is not same version as the CD in use."""
 
     label = None
@@ -68,11 +72,44 @@ def restoreFromBackup(backup, progress=lambda x: ()):
             raise RuntimeError("Backup uses grub bootloader which is no longer supported - " + \
                 "to restore please use a version of the installer that matches the backup partition")
 
-        # format the restore partition(s):
+        # check that the backup is complete and intact before wiping the root
         try:
-            util.mkfs(constants.rootfs_type, restore_partition)
-        except Exception as e:
-            raise RuntimeError("Failed to create root filesystem: %s" % e)
+            manifest = backupmanifest.readManifest(backup_fs.mount_point)
+        except ValueError as e:
+            raise RuntimeError("Backup on %s has an unreadable manifest: %s" % (backup_partition, e))
+        base = 0
+        if manifest:
+            verify_throughput = treecopy.Throughput()
+            def verify_progress(done, total):
+                verify_throughput.update(done)
+                progress(30 * done / total if total else 0,
+                         "Verifying backup: %s" % verify_throughput.describe(done, total))
+            problems = manifest.verify(backup_fs.mount_point, True, verify_progress)
+            if problems:
+                raise RuntimeError("Backup on %s is damaged or incomplete: %d files differ from its manifest, including %s" %
+                                   (backup_partition, len(problems), ', '.join(problems[:3])))
+            base = 30
+        else:
+            logger.log("Backup on %s has no manifest, so cannot be verified" % backup_partition)
+
+        throughput = treecopy.Throughput()
+        def copy_progress(done, total):
+            throughput.update(done)
+            progress(base + ((100 - base) * done / total if total else 0),
+                     "Restoring data: %s" % throughput.describe(done, total))
+
+        # format the restore partition(s), or image the backup onto it:
+        imaged = constants.IMAGE_BACKUP and extimage.imageable(backup_partition, restore_partition)
+        if imaged:
+            try:
+                extimage.imageFilesystem(backup_partition, restore_partition, copy_progress)
+            except Exception as e:
+                raise RuntimeError("Failed to image root filesystem: %s" % e)
+        else:
+            try:
+                util.mkfs(constants.rootfs_type, restore_partition)
+            except Exception as e:
+                raise RuntimeError("Failed to create root filesystem: %s" % e)
 
         if efi_boot:
             try:
@@ -84,24 +121,37 @@ def restoreFromBackup(backup, progress=lambda x: ()):
         dest_fs = util.TempMount(restore_partition, 'restore-dest-')
         efi_mounted = False
         try:
+            backup_files = ['lost+found', '.xen-backup-partition', '.xen-gpt.bin', backupmanifest.MANIFEST_FILE]
+            if imaged:
+                for x in backup_files[1:]:
+                    path = os.path.join(dest_fs.mount_point, x)
+                    if os.path.lexists(path):
+                        os.unlink(path)
+
             if efi_boot:
                 esp = os.path.join(dest_fs.mount_point, 'boot', 'efi')
-                os.makedirs(esp)
+                if imaged:
+                    # the image holds the boot filesystem's files beneath
+                    # its mount point, so move them onto it
+                    esp_fs = util.TempMount(boot_device, 'restore-esp-')
+                    try:
+                        treecopy.copyTree(esp, esp_fs.mount_point)
+                    finally:
+                        esp_fs.unmount()
+                    for x in os.listdir(esp):
+                        treecopy.remove(os.path.join(esp, x))
+                else:
+                    os.makedirs(esp)
                 util.mount(boot_device, esp)
                 efi_mounted = True
 
-            # copy files from the backup partition to the restore partition:
-            objs = [x for x in os.listdir(backup_fs.mount_point) if x not in ['lost+found', '.xen-backup-partition', '.xen-gpt.bin']]
-            for i in range(len(objs)):
-                obj = objs[i]
-                logger.log("Restoring subtree %s..." % obj)
-                progress((i * 100) / len(objs))
-
-                # Use 'cp' here because Python's copying tools are useless and
-                # get stuck in an infinite loop when copying e.g. /dev/null.
-                if util.runCmd2(['cp', '-a', os.path.join(backup_fs.mount_point, obj),
-                                 dest_fs.mount_point]) != 0:
-                    raise RuntimeError("Failed to restore %s directory" % obj)
+            if not imaged:
+                # copy files from the backup partition to the restore partition:
+                objs = [x for x in os.listdir(backup_fs.mount_point) if x not in backup_files]
+                try:
+                    treecopy.copyTree(backup_fs.mount_point, dest_fs.mount_point, objs, copy_progress)
+                except EnvironmentError as e:
+                    raise RuntimeError("Failed to restore data: %s" % e)
 
             logger.log("Data restoration complete.  About to re-install bootloader.")
 
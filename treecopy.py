@@ -0,0 +1,368 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+""" Copies directory trees in-process, as 'cp -a' would, using a pool of
+worker threads.  Ownership, permissions, timestamps, extended attributes
+(and so ACLs), symlinks, device nodes, hard links and holes in sparse files
+are preserved. """
+
+import os
+import stat
+import errno
+import shutil
+import time
+import threading
+import collections
+import concurrent.futures
+
+import constants
+from xcp import logger
+
+# bytes copied by each read/write or copy_file_range call
+COPY_CHUNK = 1024 * 1024
+
+# work handed to a worker at once: up to this many entries, or one entry of
+# at least this many bytes
+BATCH_ENTRIES = 64
+BATCH_BYTES = 8 * 1024 * 1024
+
+_use_copy_file_range = hasattr(os, 'copy_file_range')
+
+# errors which mean an extended attribute cannot be kept on the destination
+XATTR_IGNORED_ERRORS = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM)
+
+def _dataExtents(fd, size):
+    """ Yields (offset, length) for each extent of the file which holds data,
+    skipping holes where the filesystem can report them. """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                # holes cannot be found: treat the rest as data
+                yield offset, size - offset
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if end > start:
+            yield start, end - start
+        offset = end
+
+def copyRange(infd, outfd, offset, length, progress=lambda x: (), hasher=None):
+    """ Copies length bytes at offset in infd to the same offset in outfd,
+    calling progress with the number of bytes copied as it proceeds.  If
+    hasher, a hashlib object, is given it is updated with the bytes written,
+    which are then passed through this process. """
+    global _use_copy_file_range
+    end = offset + length
+    while offset < end:
+        count = min(end - offset, COPY_CHUNK)
+        if _use_copy_file_range and hasher is None:
+            try:
+                n = os.copy_file_range(infd, outfd, count, offset, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                # e.g. copying between filesystems on older kernels
+                _use_copy_file_range = False
+                continue
+        else:
+            data = os.pread(infd, count, offset)
+            n = os.pwrite(outfd, data, offset) if data else 0
+            if hasher is not None:
+                hasher.update(data[:n])
+        if n == 0:
+            # the file was truncated under us
+            break
+        offset += n
+        progress(n)
+
+def copyXattrs(src, dst):
+    """ Copies the extended attributes of src, including any ACLs, to dst.
+    Neither is followed if it is a symlink. """
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in XATTR_IGNORED_ERRORS:
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False),
+                        follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in XATTR_IGNORED_ERRORS:
+                raise
+
+def copyMetadata(src, dst, st):
+    """ Sets the ownership, permissions, extended attributes and timestamps
+    of dst to those of src, which has lstat result st. """
+    os.lchown(dst, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        # after chown, which clears set-id bits
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    copyXattrs(src, dst)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+def _replace(dst, create):
+    """ Calls create(), first removing dst if it already exists. """
+    try:
+        create()
+    except FileExistsError:
+        remove(dst)
+        create()
+
+def remove(path):
+    """ Removes path, and everything beneath it if it is a directory. """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def unchanged(dst, st):
+    """ Returns True if dst appears to be an up to date copy of an entry
+    with lstat result st: it has the same type, permissions, ownership and
+    modification time, and the same size, link target or device. """
+    try:
+        dst_st = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    if (dst_st.st_mode, dst_st.st_uid, dst_st.st_gid, dst_st.st_mtime_ns) != \
+            (st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns):
+        return False
+    if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+        return dst_st.st_size == st.st_size
+    if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        return dst_st.st_rdev == st.st_rdev
+    return True
+
+def _hashZeros(hasher, length):
+    while length > 0:
+        count = min(length, COPY_CHUNK)
+        hasher.update(bytes(count))
+        length -= count
+
+def copyEntry(src, dst, st, progress=lambda x: (), hasher=None):
+    """ Copies the file, symlink or special file src, which has lstat result
+    st, to dst.  progress is called with the number of bytes copied as the
+    copy proceeds.  If hasher, a hashlib object, is given it is updated with
+    the contents written to a file, holes included. """
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        infd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            outfd = None
+            copied = [0]
+            def create():
+                nonlocal outfd
+                outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            _replace(dst, create)
+            try:
+                def count(n):
+                    copied[0] += n
+                    progress(n)
+                hashed = 0
+                for offset, length in _dataExtents(infd, st.st_size):
+                    if hasher is not None:
+                        _hashZeros(hasher, offset - hashed)
+                        hashed = offset + length
+                    copyRange(infd, outfd, offset, length, count, hasher)
+                # extend over any trailing hole
+                os.ftruncate(outfd, st.st_size)
+                if hasher is not None:
+                    _hashZeros(hasher, st.st_size - hashed)
+            finally:
+                os.close(outfd)
+        finally:
+            os.close(infd)
+        # count holes as copied
+        if st.st_size > copied[0]:
+            progress(st.st_size - copied[0])
+    elif stat.S_ISLNK(mode):
+        target = os.readlink(src)
+        _replace(dst, lambda: os.symlink(target, dst))
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+        _replace(dst, lambda: os.mknod(dst, mode, st.st_rdev))
+    else:
+        raise IOError("Cannot copy %s: unknown file type" % src)
+    copyMetadata(src, dst, st)
+
+class TreeCopy(object):
+    """ A copy of entries in one directory, and everything beneath them, to
+    another.  Directories are created while the source is walked, files are
+    copied by a pool of workers, and then hard links are made and the
+    metadata of the directories is set.
+
+    If update is set, dst is brought up to date with src instead: entries
+    which are unchanged are not copied again, and entries beneath the copied
+    directories which are not in src are removed.
+
+    If hasher, a hashlib constructor, is given, the digest of each file
+    copied is taken from the bytes written and kept in digests, by relative
+    path.  Files which were unchanged are kept in skipped instead.  After
+    run, dirs, entries and links hold what walk returned. """
+
+    def __init__(self, src, dst, names=None, workers=None, update=False, hasher=None):
+        self.src = src
+        self.dst = dst
+        self.names = sorted(os.listdir(src)) if names is None else names
+        self.workers = workers or constants.COPY_WORKERS
+        self.update = update
+        self.hasher = hasher
+        self.digests = {}
+        self.skipped = set()
+        self.dirs = self.entries = self.links = []
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self._lock = threading.Lock()
+
+    def _progress(self, n):
+        with self._lock:
+            self.done_bytes += n
+
+    def walk(self):
+        """ Creates the destination directories and returns lists of
+        (relative path, lstat result) for the directories, the entries to
+        copy, and the hard links to make to them. """
+        dirs = []
+        entries = []
+        links = []
+        inodes = {}
+
+        def visit(path, st):
+            if stat.S_ISDIR(st.st_mode):
+                dst = os.path.join(self.dst, path)
+                try:
+                    os.mkdir(dst, 0o700)
+                except FileExistsError:
+                    if not os.path.isdir(dst) or os.path.islink(dst):
+                        os.unlink(dst)
+                        os.mkdir(dst, 0o700)
+                dirs.append((path, st))
+                stack.append(path)
+                return
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in inodes:
+                    links.append((path, inodes[key]))
+                    return
+                inodes[key] = path
+            entries.append((path, st))
+            if stat.S_ISREG(st.st_mode):
+                self.total_bytes += st.st_size
+
+        stack = []
+        for name in self.names:
+            visit(name, os.lstat(os.path.join(self.src, name)))
+        while stack:
+            path = stack.pop()
+            found = set()
+            with os.scandir(os.path.join(self.src, path)) as it:
+                for entry in it:
+                    found.add(entry.name)
+                    visit(os.path.join(path, entry.name), entry.stat(follow_symlinks=False))
+            if self.update:
+                for name in os.listdir(os.path.join(self.dst, path)):
+                    if name not in found:
+                        remove(os.path.join(self.dst, path, name))
+        return dirs, entries, links
+
+    def _batches(self, entries):
+        batch = []
+        size = 0
+        for path, st in entries:
+            batch.append((path, st))
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+            if len(batch) >= BATCH_ENTRIES or size >= BATCH_BYTES:
+                yield batch
+                batch = []
+                size = 0
+        if batch:
+            yield batch
+
+    def _copyBatch(self, batch):
+        for path, st in batch:
+            dst = os.path.join(self.dst, path)
+            if self.update and unchanged(dst, st):
+                if stat.S_ISREG(st.st_mode):
+                    self._progress(st.st_size)
+                    with self._lock:
+                        self.skipped.add(path)
+                continue
+            hasher = self.hasher() if self.hasher and stat.S_ISREG(st.st_mode) else None
+            copyEntry(os.path.join(self.src, path), dst, st, self._progress, hasher)
+            if hasher is not None:
+                with self._lock:
+                    self.digests[path] = hasher.hexdigest()
+
+    def _link(self, path, target):
+        dst = os.path.join(self.dst, path)
+        _replace(dst, lambda: os.link(os.path.join(self.dst, target), dst))
+
+    def _dirMetadata(self, batch):
+        for path, st in batch:
+            copyMetadata(os.path.join(self.src, path), os.path.join(self.dst, path), st)
+
+    def _run(self, pool, fn, work, progress):
+        pending = [pool.submit(fn, *args) for args in work]
+        while pending:
+            finished, pending = concurrent.futures.wait(
+                pending, timeout=0.5, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for f in finished:
+                if f.exception():
+                    for p in pending:
+                        p.cancel()
+                    raise f.exception()
+            progress(self.done_bytes, self.total_bytes)
+
+    def run(self, progress=lambda done, total: ()):
+        """ Performs the copy.  progress is called from this thread with the
+        number of bytes copied so far and the total. """
+        self.dirs, self.entries, self.links = dirs, entries, links = self.walk()
+        logger.log("Copying %d directories, %d entries (%d bytes) and %d links from %s to %s" %
+                   (len(dirs), len(entries), self.total_bytes, len(links), self.src, self.dst))
+        progress(0, self.total_bytes)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            self._run(pool, self._copyBatch, [(b,) for b in self._batches(entries)], progress)
+            # links change the mtime of their directory, so come first
+            self._run(pool, self._link, links, progress)
+            self._run(pool, self._dirMetadata, [(b,) for b in self._batches(dirs)], progress)
+
+class Throughput(object):
+    """ Estimates the rate of a copy, and the time it has left, from the
+    progress made over the last window seconds. """
+
+    def __init__(self, window=10):
+        self.window = window
+        self.samples = collections.deque()
+
+    def update(self, done):
+        now = time.time()
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+    def rate(self):
+        """ Returns the rate in bytes per second, or None if not yet known. """
+        if len(self.samples) < 2:
+            return None
+        (start, start_done), (end, end_done) = self.samples[0], self.samples[-1]
+        if end <= start:
+            return None
+        return (end_done - start_done) / (end - start)
+
+    def describe(self, done, total):
+        """ Returns a short description of the progress, rate and time left. """
+        text = "%.1f of %.1f GB" % (done / 1e9, total / 1e9)
+        rate = self.rate()
+        if rate:
+            left = int((total - done) / rate)
+            text += " at %d MB/s, %d:%02d left" % (rate / 1e6, left // 60, left % 60)
+        return text
+
+def copyTree(src, dst, names=None, progress=lambda done, total: (), update=False):
+    """ Copies the entries names (by default, all entries) of directory src,
+    and everything beneath them, into the existing directory dst.  Like
+    'cp -a src/name... dst/', or if update is set, like 'rsync -aHAX
+    --delete'.  Raises OSError on failure. """
+    TreeCopy(src, dst, names, update=update).run(progress)
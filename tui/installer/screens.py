@@ -105,8 +105,8 @@ To setup advanced storage classes press <F10>.
         return EXIT
 
     logger.log("Waiting for partitions to appear...")
-    util.runCmd2(util.udevsettleCmd())
-    time.sleep(1)
+    util.waitForUdev(lambda: util.runCmd2(util.udevsettleCmd()), 1)
+    util.blockDevicesChanged()
     diskutil.mpath_part_scan()
 
     # ensure partitions/disks are not locked by LVM
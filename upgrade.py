@@ -12,6 +12,9 @@ from disktools import *
 from netinterface import *
 import util
 import constants
+import treecopy
+import extimage
+import backupmanifest
 import version
 import netutil
 
@@ -208,6 +211,35 @@ class ThirdGenUpgrader(Upgrader):
 
         primary_fs.unmount()
 
+    def backupReusable(self, backup_partition):
+        """ Returns True if backup_partition holds a complete backup of this
+        installation at the same build, which can be brought up to date
+        rather than copied again. """
+        try:
+            if diskutil.filesystemType(backup_partition) != 'ext3':
+                return False
+            if util.runCmd2(['e2fsck', '-p', backup_partition]) >= 4:
+                logger.log("Backup filesystem on %s has errors" % backup_partition)
+                return False
+            backup_fs = util.TempMount(backup_partition, 'backup-', ['ro'], 'ext3')
+            try:
+                if not os.path.exists(os.path.join(backup_fs.mount_point, '.xen-backup-partition')):
+                    return False
+                inventory = util.readKeyValueFile(os.path.join(backup_fs.mount_point, constants.INVENTORY_FILE),
+                                                  strip_quotes=True)
+            finally:
+                backup_fs.unmount()
+        except Exception as e:
+            logger.log("Cannot reuse backup on %s: %s" % (backup_partition, e))
+            return False
+
+        for key in ['INSTALLATION_UUID', 'PRODUCT_VERSION', 'BUILD_NUMBER']:
+            if inventory.get(key) != self.source.inventory.get(key):
+                logger.log("Cannot reuse backup on %s: %s is %s, not %s" %
+                           (backup_partition, key, inventory.get(key), self.source.inventory.get(key)))
+                return False
+        return True
+
     def testUpgradeForbidden(self, tool):
         utilparts = tool.utilityPartitions()
         if tool.partTableType == constants.PARTITION_DOS and utilparts is not None:
@@ -270,10 +302,12 @@ class ThirdGenUpgrader(Upgrader):
                         _, vgs_label = vgs_output_wrong.split(None, 1)
                         util.runCmd2(['vgremove', '-f', vgs_label])
                 util.runCmd2(['vgcreate', self.vgs_output, storage_part])
+                LVMTool.invalidateSnapshot()
 
                 if self.storage_type == 'ext':
                     _, sr_uuid = self.vgs_output.split('-', 1)
                     util.runCmd2(['lvcreate', '-n', sr_uuid, '-l', '100%VG', self.vgs_output])
+                    LVMTool.invalidateSnapshot()
                     try:
                         util.mkfs('ext3', '/dev/' + self.vgs_output + '/' + sr_uuid, ['-F'])
                     except Exception as e:
@@ -297,6 +331,7 @@ class ThirdGenUpgrader(Upgrader):
         logs_partition = tool.getPartition(logs_partnum)
 
         self.testUpgradeForbidden(tool)
+        resized = False
 
         # Check if possible to create new partition layout, increasing the size, using plugin result
         if self.safe2upgrade and logs_partition is None: 
@@ -315,63 +350,126 @@ class ThirdGenUpgrader(Upgrader):
                     # Remove LVM Phisical Volume
                     storage_part = partitionDevice(target_disk, storage_partnum)
                     util.runCmd2(['pvremove', storage_part])
+                    LVMTool.invalidateSnapshot()
                 # Delete LVM partition
                 tool.deletePartition(storage_partnum)
             # Resize backup partition
             tool.resizePartition(number=backup_partnum, sizeBytes=constants.backup_size * 2**20)
+            resized = True
             # Write partition table
             tool.commit(log=True)
 
-        # format the backup partition:
+        # format the backup partition, unless it already holds a backup of
+        # this installation which can be brought up to date, or the root
+        # filesystem is to be imaged onto it:
         backup_partition = partitionDevice(target_disk, backup_partnum)
-        try:
-            util.mkfs('ext3', backup_partition)
-        except Exception as e:
-            raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
-        progress_callback(10)
+        incremental = constants.INCREMENTAL_BACKUP and not resized and self.backupReusable(backup_partition)
+        imaged = False
+        if incremental:
+            logger.log("Updating existing backup on %s" % backup_partition)
+            progress_callback(10)
+        elif constants.IMAGE_BACKUP and extimage.imageable(self.source.root_device, backup_partition):
+            def image_progress(done, total):
+                progress_callback(70 * done / total if total else 0)
+            try:
+                extimage.imageFilesystem(self.source.root_device, backup_partition, image_progress)
+            except Exception as e:
+                raise RuntimeError("Backup: Failed to image %s to %s: %s" % (self.source.root_device, backup_partition, e))
+            imaged = True
+        else:
+            try:
+                util.mkfs('ext3', backup_partition)
+            except Exception as e:
+                raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+            progress_callback(10)
 
         # copy the files across:
         primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'], boot_device=boot_device)
         try:
             backup_fs = util.TempMount(backup_partition, 'backup-')
             try:
-                just_dirs = ['dev', 'proc', 'lost+found', 'sys']
-                top_dirs = os.listdir(primary_fs.mount_point)
-                val = 10
-                for x in top_dirs:
-                    if x in just_dirs:
-                        path = os.path.join(backup_fs.mount_point, x)
-                        if not os.path.exists(path):
-                            os.mkdir(path, 0o755)
-                    else:
-                        cmd = ['cp', '-a'] + \
-                              [ os.path.join(primary_fs.mount_point, x) ] + \
-                              ['%s/' % backup_fs.mount_point]
-                        if util.runCmd2(cmd) != 0:
-                            raise RuntimeError("Backup of %s directory failed" % x)
-                    val += 90 / len(top_dirs)
-                    progress_callback(val)
-
-                # save the GPT table
-                rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_fs.mount_point, '.xen-gpt.bin'), target_disk], with_stderr=True)
-                if rc != 0:
-                    raise RuntimeError("Failed to save partition layout: %s" % err)
-            finally:
-                # replace rolling pool upgrade bootloader config
-                def replace_config(config_file, destination):
-                    src = os.path.join(backup_fs.mount_point, constants.ROLLING_POOL_DIR, config_file)
-                    if os.path.exists(src):
-                        util.runCmd2(['cp', '-f', src, os.path.join(backup_fs.mount_point, destination)])
-
-                configMaps = [("efi-grub.cfg", "boot/efi/EFI/xenserver/grub.cfg"),
-                                ("grub.cfg", "boot/grub"),
-                                ("menu.lst", "boot/grub"),
-                                ("extlinux.conf", "boot")]
-                for config_file, destination in configMaps:
-                    replace_config(config_file, destination)
-
+                manifest = None
+                try:
+                    just_dirs = ['dev', 'proc', 'lost+found', 'sys']
+                    top_dirs = os.listdir(primary_fs.mount_point)
+                    names = [x for x in top_dirs if x not in just_dirs]
+                    previous = None
+                    if incremental:
+                        # files which have not changed need not be hashed again
+                        try:
+                            previous = backupmanifest.readManifest(backup_fs.mount_point)
+                        except ValueError as e:
+                            logger.log("Ignoring previous backup manifest: %s" % e)
+                        # the backup is incomplete until the marker is rewritten
+                        os.unlink(os.path.join(backup_fs.mount_point, '.xen-backup-partition'))
+                        for x in os.listdir(backup_fs.mount_point):
+                            if x not in top_dirs and x not in ['lost+found', '.xen-gpt.bin']:
+                                treecopy.remove(os.path.join(backup_fs.mount_point, x))
+                    for x in top_dirs:
+                        if x in just_dirs:
+                            path = os.path.join(backup_fs.mount_point, x)
+                            if not os.path.exists(path):
+                                os.mkdir(path, 0o755)
+
+                    # files are hashed as they are copied, so only an image
+                    # leaves much to hash afterwards
+                    hashed_from = 70 if imaged else 90
+                    def copy_progress(done, total):
+                        progress_callback(10 + ((hashed_from - 10) * done / total if total else 0))
+                    def manifest_progress(done, total):
+                        progress_callback(hashed_from + ((100 - hashed_from) * done / total if total else 0))
+                    try:
+                        if imaged:
+                            # the image holds the root filesystem only, so copy
+                            # the boot filesystem mounted within it
+                            if primary_fs.boot_mounted:
+                                rel = os.path.relpath(primary_fs.boot_mount_point, primary_fs.mount_point)
+                                boot_dest = os.path.join(backup_fs.mount_point, rel)
+                                treecopy.copyTree(primary_fs.boot_mount_point, boot_dest)
+                                treecopy.copyMetadata(primary_fs.boot_mount_point, boot_dest,
+                                                      os.lstat(primary_fs.boot_mount_point))
+                            # record what was written, by reading it back
+                            recorded = backupmanifest.Manifest.fromTree(backup_fs.mount_point, names,
+                                                                        None, manifest_progress)
+                        else:
+                            # record what the backup should contain as it is
+                            # written
+                            copy = treecopy.TreeCopy(primary_fs.mount_point, backup_fs.mount_point, names,
+                                                     update=incremental, hasher=backupmanifest.HASH)
+                            copy.run(copy_progress)
+                            recorded = backupmanifest.Manifest.fromCopy(copy, previous, manifest_progress)
+                    except EnvironmentError as e:
+                        raise RuntimeError("Backup failed: %s" % e)
+                    progress_callback(100)
+
+                    # save the GPT table
+                    rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_fs.mount_point, '.xen-gpt.bin'), target_disk], with_stderr=True)
+                    if rc != 0:
+                        raise RuntimeError("Failed to save partition layout: %s" % err)
+                    manifest = recorded
+                finally:
+                    # replace rolling pool upgrade bootloader config
+                    def replace_config(config_file, destination):
+                        src = os.path.join(backup_fs.mount_point, constants.ROLLING_POOL_DIR, config_file)
+                        if os.path.exists(src):
+                            util.runCmd2(['cp', '-f', src, os.path.join(backup_fs.mount_point, destination)])
+                            if os.path.isdir(os.path.join(backup_fs.mount_point, destination)):
+                                destination = os.path.join(destination, config_file)
+                            if manifest:
+                                manifest.update(backup_fs.mount_point, destination)
+
+                    configMaps = [("efi-grub.cfg", "boot/efi/EFI/xenserver/grub.cfg"),
+                                    ("grub.cfg", "boot/grub"),
+                                    ("menu.lst", "boot/grub"),
+                                    ("extlinux.conf", "boot")]
+                    for config_file, destination in configMaps:
+                        replace_config(config_file, destination)
+
+                # only a complete backup has a manifest and is marked as such
+                manifest.write(os.path.join(backup_fs.mount_point, backupmanifest.MANIFEST_FILE))
                 fh = open(os.path.join(backup_fs.mount_point, '.xen-backup-partition'), 'w')
                 fh.close()
+            finally:
                 backup_fs.unmount()
         finally:
             primary_fs.unmount()
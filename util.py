@@ -12,6 +12,10 @@ import random
 import string
 import tempfile
 import errno
+import threading
+import socket
+import select
+import struct
 from version import *
 from xcp import logger
 
@@ -48,6 +52,57 @@ def copyFilesFromDir(sourcedir, dest):
     for f in files:
         assert runCmd2(['cp', '-a', '%s/%s' % (sourcedir, f), '%s/' % dest]) == 0
 
+###
+# per-thread statistics, used to profile install steps
+
+_thread_stats = threading.local()
+
+def countSubprocess():
+    """ Record that the calling thread started a subprocess.  Call this
+    wherever subprocess.Popen is used directly rather than via runCmd2. """
+    _thread_stats.subprocesses = subprocessCount() + 1
+
+def subprocessCount():
+    """ Number of subprocesses started by the calling thread. """
+    return getattr(_thread_stats, 'subprocesses', 0)
+
+def subprocessUsage():
+    """ (CPU seconds, bytes written to storage) of the subprocesses the
+    calling thread has reaped with waitSubprocess, as runCmd2 does.  Unlike
+    RUSAGE_CHILDREN these exclude subprocesses of other threads, but also
+    subprocesses waited for in any other way. """
+    return (getattr(_thread_stats, 'child_cpu_time', 0.0),
+            getattr(_thread_stats, 'child_bytes_written', 0))
+
+def waitSubprocess(proc):
+    """ Wait for proc, a subprocess.Popen whose output has been read, and
+    return its exit code, adding its resource usage to that of the calling
+    thread (see subprocessUsage). """
+    if proc.returncode is not None:
+        return proc.returncode
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # reaped elsewhere: its usage is lost
+        return proc.wait()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    cpu_time, bytes_written = subprocessUsage()
+    _thread_stats.child_cpu_time = cpu_time + usage.ru_utime + usage.ru_stime
+    _thread_stats.child_bytes_written = bytes_written + usage.ru_oublock * 512
+    return proc.returncode
+
+def threadBytesWritten():
+    """ Bytes the calling thread has caused to be written to storage, or 0 if
+    the kernel does not provide per-thread I/O accounting. """
+    try:
+        with open('/proc/thread-self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
 ###
 # shell
 
@@ -58,18 +113,32 @@ def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None):
     """
 
     try:
-        cmd = subprocess.Popen(command, bufsize=1,
-                               stdin=(inputtext and subprocess.PIPE or None),
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=isinstance(command, str),
-                               universal_newlines=True,
-                               close_fds=True)
-
-        # We could poll stdout/stderr for commands outputing large amounts
-        # of data, but the following should suffice in all cases
-        (out, err) = cmd.communicate(inputtext)
-        rv = cmd.returncode
+        countSubprocess()
+        # Output goes to files rather than pipes, so that the command cannot
+        # block on it and can be reaped by waitSubprocess once input is sent
+        with tempfile.TemporaryFile('w+') as stdout, tempfile.TemporaryFile('w+') as stderr:
+            cmd = subprocess.Popen(command,
+                                   stdin=(inputtext and subprocess.PIPE or None),
+                                   stdout=stdout,
+                                   stderr=stderr,
+                                   shell=isinstance(command, str),
+                                   universal_newlines=True,
+                                   close_fds=True)
+            if inputtext:
+                # the command may exit without reading all its input
+                try:
+                    cmd.stdin.write(inputtext)
+                except BrokenPipeError:
+                    pass
+                try:
+                    cmd.stdin.close()
+                except BrokenPipeError:
+                    pass
+            rv = waitSubprocess(cmd)
+            stdout.seek(0)
+            out = stdout.read()
+            stderr.seek(0)
+            err = stderr.read()
     except Exception as ex:
         logger.log("running %s caused an exception: %s" % (command, ex))
         raise
@@ -350,6 +419,125 @@ def udevadmCmd(cmd):
 def udevsettleCmd():
     return udevadmCmd('settle')
 
+# Bumped whenever block devices or partitions may have come or gone, so that
+# anything cached about them can be discarded.
+_block_device_generation = 0
+
+def blockDevicesChanged():
+    """ Note that the set of block devices or their partitions may have
+    changed, e.g. after writing a partition table or waiting for udev. """
+    global _block_device_generation
+    _block_device_generation += 1
+
+def blockDeviceGeneration():
+    return _block_device_generation
+
+###
+# uevents
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UDEV_MONITOR_PREFIX = b'libudev\0'
+
+class UeventMonitor(object):
+    """ Receives device events as the kernel sends them and as udev
+    finishes handling them.  Create the monitor before whatever causes the
+    events, so that none are missed. """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.bind((0, UEVENT_GROUP_KERNEL | UEVENT_GROUP_UDEV))
+        except:
+            self.sock.close()
+            raise
+
+    @classmethod
+    def open(cls):
+        """ Returns a new UeventMonitor, or None if uevents are unavailable. """
+        try:
+            return cls()
+        except (OSError, AttributeError) as e:
+            logger.log("Cannot monitor uevents: %s" % str(e))
+            return None
+
+    def close(self):
+        self.sock.close()
+
+    def receive(self, timeout):
+        """ Returns the next event as a dict of its properties, with
+        'from-udev' set if udev sent it, or None after timeout seconds. """
+        if not select.select([self.sock], [], [], max(0, timeout))[0]:
+            return None
+        try:
+            data = self.sock.recv(65536)
+        except OSError:
+            # e.g. ENOBUFS: events were lost, but something happened
+            return {}
+
+        from_udev = data.startswith(UDEV_MONITOR_PREFIX)
+        if from_udev:
+            # struct udev_monitor_netlink_header: prefix, magic, header
+            # size, then the offset and length of the properties
+            offset, length = struct.unpack_from('=II', data, 16)
+            data = data[offset:offset + length]
+        else:
+            # Kernel events start 'action@devpath'
+            data = data.split(b'\0', 1)[-1]
+
+        event = {'from-udev': from_udev}
+        for item in data.split(b'\0'):
+            key, sep, value = item.decode('utf-8', 'replace').partition('=')
+            if sep:
+                event[key] = value
+        return event
+
+    def waitQuiet(self, quiet, timeout, subsystem=None):
+        """ Waits until udev has handled every event the kernel has sent
+        (for subsystem, if given) and no more have arrived for quiet seconds,
+        or until timeout seconds have passed. """
+        deadline = time.time() + timeout
+        last = time.time()
+        pending = set()
+        while True:
+            now = time.time()
+            if now >= deadline:
+                if pending:
+                    logger.log("Timed out waiting for udev to handle %d events" % len(pending))
+                return
+            if not pending and now >= last + quiet:
+                return
+            event = self.receive(min(deadline, last + quiet) - now if not pending else deadline - now)
+            if event is None or (subsystem and event.get('SUBSYSTEM') != subsystem):
+                continue
+            last = time.time()
+            seqnum = event.get('SEQNUM')
+            if event.get('from-udev'):
+                pending.discard(seqnum)
+            elif seqnum:
+                pending.add(seqnum)
+
+def waitForUdev(settle, delay, quiet=0.25, subsystem=None, monitor=None):
+    """ Waits for udev to finish handling device events.  This replaces
+    sleeping for delay seconds and calling settle, and finishes as soon as
+    udev has handled every event and then been quiet for quiet seconds.
+    Events sent before the call are only seen through monitor, a
+    UeventMonitor opened before whatever caused them, which is left open. """
+    own = monitor is None
+    if own:
+        monitor = UeventMonitor.open()
+    if monitor is None:
+        time.sleep(delay)
+        settle()
+        return
+    try:
+        settle()
+        monitor.waitQuiet(quiet, delay, subsystem)
+    finally:
+        if own:
+            monitor.close()
+
 def udevtriggerCmd():
     return udevadmCmd('trigger')
 
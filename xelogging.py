@@ -8,8 +8,41 @@ import sys
 import fcntl
 import datetime
 import traceback
+import threading
+import time
+import json
 import constants
 
+_profile = []
+_profile_lock = threading.Lock()
+
+def startProfilePhase(name):
+    """ Start a new phase in the install profile; task profiles recorded
+    after this are attributed to it. """
+    with _profile_lock:
+        _profile.append({'phase': name, 'started': time.time(), 'wall-time': 0, 'tasks': []})
+        _writeProfile()
+
+def recordTaskProfile(entry):
+    """ Add the profile of a completed task (a dict including its
+    'wall-time') to the current phase and rewrite the profile log. """
+    with _profile_lock:
+        if not _profile:
+            _profile.append({'phase': None, 'started': time.time(), 'wall-time': 0, 'tasks': []})
+        phase = _profile[-1]
+        end = time.time() - phase['started']
+        entry = dict(entry, start=end - entry['wall-time'])
+        phase['tasks'].append(entry)
+        phase['wall-time'] = max(phase['wall-time'], end)
+        _writeProfile()
+
+def _writeProfile():
+    try:
+        with open(constants.INSTALL_PROFILE, 'w') as f:
+            json.dump(_profile, f, indent=2)
+    except IOError:
+        pass
+
 
 def collectLogs(dst, tarball_dir=None):
     """ Make a support tarball including all logs (and some more) from 'dst'."""
@@ -36,9 +69,12 @@ def collectLogs(dst, tarball_dir=None):
     if dst != '/tmp':
         if os.path.exists("/tmp/install-log"):
             shutil.copy("/tmp/install-log", dst)
+        if os.path.exists(constants.INSTALL_PROFILE):
+            shutil.copy(constants.INSTALL_PROFILE, dst)
         if os.path.exists(constants.SCRIPTS_DIR):
             os.system("cp -r "+constants.SCRIPTS_DIR+" %s/" % dst)
     logs = [x for x in os.listdir(dst) if x.endswith('-log') or x == 'answerfile' or
+                  x == os.path.basename(constants.INSTALL_PROFILE) or
                   x.startswith(os.path.basename(constants.SCRIPTS_DIR))]
     logs = " ".join(logs)
 